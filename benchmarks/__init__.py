@@ -0,0 +1,8 @@
+"""
+Benchmarks for cases2kml.
+
+Each module can be run from the top of the source tree, eg:
+
+   $ python -m benchmarks.bench_dates
+
+"""
@@ -0,0 +1,80 @@
+"""
+Measures the time/size trade-off of the KMZ compression settings.
+
+A synthetic input is read once, then the document is written with each
+of the cases2kml.COMPRESSION settings and as plain .kml, reporting the
+time taken and size of each file.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+from zipfile import ZipFile
+from optparse import OptionParser
+
+from cases2kml import Cases2kml, COMPRESSION
+from benchmarks.synthetic import writeCases
+
+
+SETTINGS = ["store","fast","default","max"]
+
+
+def writeOutput(converter,fileName,compression):
+    """Writes converter's document to fileName, as a .kmz file with the
+    given compression setting, or as plain KML if compression is None"""
+    if compression == None:
+        kmlFile = open(fileName,"wb")
+        converter.write(kmlFile,"benchmark")
+        kmlFile.close()
+    else:
+        compressType,compressLevel = COMPRESSION[compression]
+        kmz = ZipFile(fileName,"w",compressType,True)
+        converter.writeKMZ(kmz,"benchmark",compressLevel=compressLevel)
+        kmz.close()
+
+
+if __name__ == "__main__":
+    optparse = OptionParser(usage="usage: %prog [options]")
+    optparse.add_option("-n","--rows",dest="rows",type="int",default=1000000,
+                        help="number of rows [default: %default]")
+    optparse.add_option("-l","--locations",dest="locations",type="int",default=20000,
+                        help="number of distinct locations [default: %default]")
+    optparse.add_option("-a","--aggregate",dest="aggregate",default="M",
+                        help="aggregation unit [default: %default]")
+    optparse.add_option("-s","--style-step",dest="styleStep",type="float",default=None,
+                        help="share point styles, as cases2kml -s [default: %default]")
+    optparse.add_option("-r","--repeat",dest="repeat",type="int",default=3,
+                        help="number of timed runs, the best is reported [default: %default]")
+    (options,args) = optparse.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory,"cases.csv")
+        writeCases(filename,options.rows,options.locations)
+        converter = Cases2kml(options.aggregate,1,1.0,'FF0000FF',options.styleStep)
+        converter.readCSV(filename,{'x': 0, 'y': 1, 'date': 2})
+
+        print "%-8s %10s %10s %8s" % ("setting","seconds","MB","ratio")
+        kmlSize = None
+        for compression in [None] + SETTINGS:
+            if compression == None:
+                outputName = os.path.join(directory,"out.kml")
+            else:
+                outputName = os.path.join(directory,"out.kmz")
+            best = None
+            for i in xrange(options.repeat):
+                start = time()
+                writeOutput(converter,outputName,compression)
+                elapsed = time() - start
+                if best == None or elapsed < best:
+                    best = elapsed
+
+            size = os.path.getsize(outputName)
+            if kmlSize == None:
+                kmlSize = size
+            print "%-8s %10.2f %10.1f %8.3f" % (compression or "kml",best,size / 1048576.0,float(size) / kmlSize)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
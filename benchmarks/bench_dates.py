@@ -0,0 +1,56 @@
+"""
+Micro-benchmark for date parsing in the readCSV hot loop.
+
+Compares the old per-row strptime() call against cases2kml._DateParser
+on a column of dates drawn from a limited pool, as in real case files.
+"""
+
+import sys
+import random
+from time import time, strptime
+from datetime import date, timedelta
+from optparse import OptionParser
+
+from cases2kml import _DateParser
+
+
+def makeDates(numRows,numDistinct,datefmt,seed=1):
+    rand = random.Random(seed)
+    start = date(2000,1,1)
+    pool = [(start + timedelta(days=i)).strftime(datefmt) for i in xrange(numDistinct)]
+    return [rand.choice(pool) for i in xrange(numRows)]
+
+
+def strptimeRows(dates,datefmt):
+    for dateString in dates:
+        parseDate = strptime(dateString,datefmt)
+        myDate = date(*parseDate[0:3])
+
+
+def parserRows(dates,datefmt):
+    parseDate = _DateParser(datefmt)
+    for dateString in dates:
+        myDate = parseDate(dateString)
+
+
+def timeRows(func,dates,datefmt):
+    start = time()
+    func(dates,datefmt)
+    return len(dates) / (time() - start)
+
+
+if __name__ == "__main__":
+    optparse = OptionParser(usage="usage: %prog [options]")
+    optparse.add_option("-n","--rows",dest="rows",type="int",default=1000000,
+                        help="number of rows [default: %default]")
+    optparse.add_option("-u","--distinct",dest="distinct",type="int",default=3000,
+                        help="number of distinct dates [default: %default]")
+    (options,args) = optparse.parse_args()
+
+    print "%-12s %14s %16s %8s" % ("format","strptime r/s","_DateParser r/s","speedup")
+    for datefmt in ["%Y-%m-%d","%d/%m/%Y","%d %b %Y"]:
+        dates = makeDates(options.rows,options.distinct,datefmt)
+        before = timeRows(strptimeRows,dates,datefmt)
+        after = timeRows(parserRows,dates,datefmt)
+        print "%-12s %14.0f %16.0f %7.1fx" % (datefmt,before,after,after/before)
+        sys.stdout.flush()
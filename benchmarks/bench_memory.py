@@ -0,0 +1,42 @@
+"""
+Reports peak resident memory after reading a synthetic case file with
+many distinct locations.
+"""
+
+import os
+import sys
+import resource
+import tempfile
+from time import time
+from optparse import OptionParser
+
+from cases2kml import Cases2kml
+from benchmarks.synthetic import writeCases
+
+
+def peakRSS():
+    """Peak resident set size of this process in MB (Linux reports kB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+if __name__ == "__main__":
+    optparse = OptionParser(usage="usage: %prog [options]")
+    optparse.add_option("-n","--rows",dest="rows",type="int",default=2000000,
+                        help="number of rows [default: %default]")
+    optparse.add_option("-l","--locations",dest="locations",type="int",default=1000000,
+                        help="number of distinct locations [default: %default]")
+    (options,args) = optparse.parse_args()
+
+    fd,filename = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        writeCases(filename,options.rows,options.locations)
+        baseline = peakRSS()
+        converter = Cases2kml('M',1,1.0,'FF0000FF')
+        start = time()
+        converter.readCSV(filename,{'x': 0, 'y': 1, 'date': 2})
+        elapsed = time() - start
+        print "rows: %i  locations: %i" % (options.rows,len(converter.meshblocks))
+        print "readCSV: %.2fs  peak RSS: %.0f MB (%.0f MB before readCSV)" % (elapsed,peakRSS(),baseline)
+    finally:
+        os.remove(filename)
@@ -0,0 +1,64 @@
+"""
+Measures KML serialisation throughput in placemarks per second.
+
+The document is streamed into a sink that discards it, so only the cost
+of rendering placemarks is measured.
+"""
+
+import os
+import sys
+import tempfile
+from time import time
+from optparse import OptionParser
+
+from cases2kml import Cases2kml
+from benchmarks.synthetic import writeCases
+
+
+class NullFile(object):
+    """Discards everything written to it, counting the bytes"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self,data):
+        self.size += len(data)
+
+
+def numPlacemarks(converter):
+    return sum([len(meshblock.cases) for meshblock in converter.meshblocks.itervalues()])
+
+
+if __name__ == "__main__":
+    optparse = OptionParser(usage="usage: %prog [options]")
+    optparse.add_option("-n","--rows",dest="rows",type="int",default=1000000,
+                        help="number of rows [default: %default]")
+    optparse.add_option("-l","--locations",dest="locations",type="int",default=20000,
+                        help="number of distinct locations [default: %default]")
+    optparse.add_option("-a","--aggregate",dest="aggregate",default="D",
+                        help="aggregation unit [default: %default]")
+    optparse.add_option("-r","--repeat",dest="repeat",type="int",default=3,
+                        help="number of timed runs, the best is reported [default: %default]")
+    (options,args) = optparse.parse_args()
+
+    fd,filename = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        writeCases(filename,options.rows,options.locations)
+        converter = Cases2kml(options.aggregate,1,1.0,'FF0000FF')
+        converter.readCSV(filename,{'x': 0, 'y': 1, 'date': 2})
+    finally:
+        os.remove(filename)
+
+    count = numPlacemarks(converter)
+    best = None
+    for i in xrange(options.repeat):
+        sink = NullFile()
+        start = time()
+        converter.write(sink,"benchmark")
+        elapsed = time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+
+    print "placemarks: %i  output: %.1f MB" % (count,sink.size / 1048576.0)
+    print "serialize: %.2fs  %.0f placemarks/sec" % (best,count / best)
@@ -0,0 +1,168 @@
+"""
+Times readCSV, serialize and the cases2kml() function end to end over a
+range of aggregations, writing the results as JSON so that runs of
+different versions can be compared, eg:
+
+   $ python -m benchmarks.bench_suite -o before.json
+   $ python -m benchmarks.bench_suite -o after.json -c before.json
+
+The synthetic input is generated from a fixed seed, so runs with the
+same settings read the same file.  The end to end timing is skipped for
+quoted input, which the cases2kml() function doesn't read.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import platform
+from time import time, strftime
+from optparse import OptionParser
+
+import cases2kml
+from cases2kml import Cases2kml
+from benchmarks.synthetic import writeCases
+from benchmarks.bench_serialize import NullFile
+
+
+def best(function,repeat):
+    """Runs function repeat times, returning the shortest time taken"""
+    times = []
+    for i in xrange(repeat):
+        start = time()
+        function()
+        times.append(time() - start)
+    return min(times)
+
+
+def runSuite(filename,aggregations,options):
+    """Returns a result dict for each benchmark and aggregation"""
+    quoteChar = ""
+    if options.quoted:
+        quoteChar = '"'
+    fieldMap = {'x': 0, 'y': 1, 'date': 2}
+    outputName = os.path.join(os.path.dirname(filename),"out.kmz")
+
+    results = []
+    for aggrUnit,aggrCount in aggregations:
+        aggr = aggrUnit
+        if aggrCount != 1:
+            aggr = "%i%s" % (aggrCount,aggrUnit)
+        first = len(results)
+        converter = Cases2kml(aggrUnit,aggrCount,1.0,'FF0000FF')
+
+        def read():
+            converter.readCSV(filename,fieldMap,options.dateformat,quoteChar)
+        seconds = best(read,options.repeat)
+        results.append({'benchmark': "readCSV", 'aggregate': aggr, 'seconds': seconds,
+                        'rows': options.rows, 'locations': len(converter.meshblocks)})
+
+        placemarks = sum([len(meshblock.cases) for meshblock in converter.meshblocks.itervalues()])
+        sink = NullFile()
+        def serialize():
+            sink.size = 0
+            converter.write(sink,"benchmark")
+        seconds = best(serialize,options.repeat)
+        results.append({'benchmark': "serialize", 'aggregate': aggr, 'seconds': seconds,
+                        'placemarks': placemarks, 'bytes': sink.size})
+        converter = None # Free the tallies before the end to end run
+
+        if not options.quoted:
+            def endToEnd():
+                # cases2kml() reports on stdout, which would swamp the results
+                stdout = sys.stdout
+                sys.stdout = open(os.devnull,"w")
+                try:
+                    cases2kml.cases2kml(filename,outputName,aggr,dateformat=options.dateformat,cache=False)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+            seconds = best(endToEnd,options.repeat)
+            results.append({'benchmark': "cases2kml", 'aggregate': aggr, 'seconds': seconds,
+                            'bytes': os.path.getsize(outputName)})
+
+        for result in results[first:]:
+            print "%-10s %6s %10.3f" % (result['benchmark'],aggr,result['seconds'])
+        sys.stdout.flush()
+    return results
+
+
+def compare(results,baseline):
+    """Prints the change in time of each benchmark from a baseline run"""
+    previous = {}
+    for result in baseline['results']:
+        previous[(result['benchmark'],result['aggregate'])] = result['seconds']
+    if baseline['settings'] != results['settings']:
+        print "Warning: the baseline was run with different settings"
+
+    print
+    print "%-10s %6s %10s %10s %8s" % ("benchmark","aggr","before","after","change")
+    for result in results['results']:
+        before = previous.get((result['benchmark'],result['aggregate']))
+        if before == None:
+            continue
+        print "%-10s %6s %10.3f %10.3f %+7.1f%%" % (result['benchmark'],result['aggregate'],before,
+                                                 result['seconds'],100.0 * (result['seconds'] - before) / before)
+
+
+if __name__ == "__main__":
+    optparse = OptionParser(usage="usage: %prog [options]")
+    optparse.add_option("-n","--rows",dest="rows",type="int",default=1000000,
+                        help="number of rows [default: %default]")
+    optparse.add_option("-l","--locations",dest="locations",type="int",default=20000,
+                        help="number of distinct locations [default: %default]")
+    optparse.add_option("-s","--days",dest="days",type="int",default=1000,
+                        help="number of days the cases are spread over [default: %default]")
+    optparse.add_option("-d","--date-format",dest="dateformat",default="%Y-%m-%d",
+                        help="date format of the input [default: %default]")
+    optparse.add_option("-q","--quoted",dest="quoted",action="store_true",default=False,
+                        help="quote every field of the input")
+    optparse.add_option("--no-ids",dest="ids",action="store_false",default=True,
+                        help="leave the id column out of the input")
+    optparse.add_option("-a","--aggregate",dest="aggregate",default="D,M,Y,7D,3M",
+                        help="comma separated aggregations to run, with optional counts [default: %default]")
+    optparse.add_option("-r","--repeat",dest="repeat",type="int",default=3,
+                        help="number of timed runs, the best is reported [default: %default]")
+    optparse.add_option("-o","--output",dest="output",default=None,
+                        help="write the results to OUTPUT as JSON")
+    optparse.add_option("-c","--compare",dest="compare",default=None,
+                        help="compare the results with those of an earlier run in COMPARE")
+    (options,args) = optparse.parse_args()
+
+    aggregations = cases2kml._parseResolutions(options.aggregate)
+    baseline = None
+    if options.compare != None:
+        baselineFile = open(options.compare)
+        baseline = json.load(baselineFile)
+        baselineFile.close()
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory,"cases.csv")
+        writeCases(filename,options.rows,options.locations,options.days,options.dateformat,
+                   quoted=options.quoted,ids=options.ids)
+        print "%-10s %6s %10s" % ("benchmark","aggr","seconds")
+        runResults = runSuite(filename,aggregations,options)
+    finally:
+        shutil.rmtree(directory)
+
+    results = {'version': cases2kml.version,
+               'date': strftime("%Y-%m-%dT%H:%M:%S"),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'settings': {'rows': options.rows,
+                            'locations': options.locations,
+                            'days': options.days,
+                            'dateformat': options.dateformat,
+                            'quoted': options.quoted,
+                            'ids': options.ids,
+                            'repeat': options.repeat},
+               'results': runResults}
+
+    if options.output != None:
+        outputFile = open(options.output,"w")
+        json.dump(results,outputFile,indent=2,sort_keys=True)
+        outputFile.close()
+    if baseline != None:
+        compare(results,baseline)
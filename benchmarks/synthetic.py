@@ -0,0 +1,45 @@
+"""
+Synthetic case data for benchmarking.
+"""
+
+import random
+from datetime import date, timedelta
+
+
+def writeCases(filename,numRows,numLocations=1000,numDays=1000,datefmt="%Y-%m-%d",seed=1,quoted=False,ids=True):
+    """Writes a CSV of numRows cases spread at random over numLocations
+    locations and numDays days, in the <long>,<lat>,<date>,<id> layout
+    expected by cases2kml.  quoted puts every field in double quotes
+    (read with quoteChar='"'), and ids=False leaves out the id column."""
+    rand = random.Random(seed)
+    start = date(2000,1,1)
+    quote = ""
+    if quoted:
+        quote = '"'
+    dates = [quote + (start + timedelta(days=i)).strftime(datefmt) + quote for i in xrange(numDays)]
+    locations = ["%s%.5f%s,%s%.5f%s" % (quote,rand.uniform(-10.0,2.0),quote,quote,rand.uniform(49.0,61.0),quote)
+                 for i in xrange(numLocations)]
+    if ids:
+        header = ["x","y","date","id"]
+        lineFormat = "%s,%s," + quote + "%d" + quote + "\n"
+    else:
+        header = ["x","y","date"]
+        lineFormat = "%s,%s\n"
+
+    csvFile = open(filename,"wb")
+    csvFile.write(",".join([quote + name + quote for name in header]) + "\n")
+    randint = rand.randint
+    lastLoc = numLocations - 1
+    lastDay = numDays - 1
+    lines = []
+    for i in xrange(numRows):
+        loc = randint(0,lastLoc)
+        if ids:
+            lines.append(lineFormat % (locations[loc],dates[randint(0,lastDay)],loc))
+        else:
+            lines.append(lineFormat % (locations[loc],dates[randint(0,lastDay)]))
+        if len(lines) == 10000:
+            csvFile.write("".join(lines))
+            lines = []
+    csvFile.write("".join(lines))
+    csvFile.close()
@@ -26,17 +26,54 @@ off conversions.  eg:
    >>> from cases2kml import cases2kml
    >>> cases2kml("myInput.csv","myOutput.kmz",'M',3.0)
 
+and cases2kmlBatch for a directory of files with the same settings:
+
+   >>> from cases2kml import cases2kmlBatch
+   >>> cases2kmlBatch("regions/","kmz/",workers=4,options={'aggr': 'M'})
+
 """
 
 import os,sys
+import re
+import glob
 import csv
+import zlib
+import mmap
+import io
+import bz2
+import gzip
+import json
+import hashlib
+import tempfile
+from array import array
+from itertools import izip,islice
+from collections import deque
+from multiprocessing import Pool
 from optparse import OptionParser
-from time import strptime
+from time import strptime,localtime,time
 from datetime import date,timedelta
-from math import sqrt
-from zipfile import ZipFile,ZIP_DEFLATED
+from math import sqrt,floor,ceil
+from zipfile import ZipFile,ZipInfo,ZIP_DEFLATED,ZIP_STORED
 from cStringIO import StringIO
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 version = "1.0-6beta"
 
 
@@ -57,22 +94,345 @@ def _addMonths(startTime,numMonths):
 class DateError(Exception):
     pass
 
-class _Meshblock:
+
+class ConversionCancelled(Exception):
+    """Raised by a progress callback to stop a conversion part way"""
+    pass
+
+
+class Status(object):
+    """How a conversion is getting on, as passed to a Cases2kml
+    statusFunction.
+
+    phase is "read" or "write".  While reading, bytesRead of totalBytes
+    of the input file have been read (totalBytes is None if that can't
+    be told, eg. for bzip2 files) and rows rows tallied.  While writing,
+    folders of totalFolders location folders, holding placemarks
+    placemarks, have been written, or for output without location
+    folders, placemarks of totalPlacemarks placemarks.  elapsed is the seconds since the
+    phase began, and finished is set on the last report of a phase."""
+
+    def __init__(self,phase,totalBytes=None,totalFolders=None,totalPlacemarks=None):
+        self.phase = phase
+        self.started = time()
+        self.elapsed = 0.0
+        self.finished = False
+        self.bytesRead = 0
+        self.totalBytes = totalBytes
+        self.rows = 0
+        self.folders = 0
+        self.totalFolders = totalFolders
+        self.placemarks = 0
+        self.totalPlacemarks = totalPlacemarks
+
+    def percent(self):
+        """Returns the percentage of the phase done, or None if unknown"""
+        if self.phase == "read" and self.totalBytes:
+            return min(100.0 * self.bytesRead / self.totalBytes,100.0)
+        if self.phase == "write" and self.totalFolders:
+            return min(100.0 * self.folders / self.totalFolders,100.0)
+        if self.phase == "write" and self.totalPlacemarks:
+            return min(100.0 * self.placemarks / self.totalPlacemarks,100.0)
+        return None
+
+    def rate(self):
+        """Returns the rows read, or placemarks written, per second"""
+        if self.elapsed <= 0:
+            return 0.0
+        if self.phase == "read":
+            return self.rows / self.elapsed
+        return self.placemarks / self.elapsed
+
+    def eta(self):
+        """Returns the estimated seconds left in the phase, or None"""
+        percent = self.percent()
+        if not percent:
+            return None
+        return self.elapsed * (100.0 - percent) / percent
+
+    def __str__(self):
+        if self.phase == "read":
+            parts = ["%s rows" % format(self.rows,","),"%s rows/s" % format(int(self.rate()),",")]
+            if self.totalBytes:
+                parts.insert(0,"%.1f of %.1f MB" % (self.bytesRead / 1048576.0,self.totalBytes / 1048576.0))
+        else:
+            parts = ["%s placemarks" % format(self.placemarks,","),"%s placemarks/s" % format(int(self.rate()),",")]
+            if self.totalFolders:
+                parts.insert(0,"%s of %s folders" % (format(self.folders,","),format(self.totalFolders,",")))
+            elif self.totalPlacemarks:
+                parts[0] = "%s of %s placemarks" % (format(self.placemarks,","),format(self.totalPlacemarks,","))
+
+        if self.finished:
+            return "%s: %s in %.1fs" % (self.phase,", ".join(parts[-2:]),self.elapsed)
+        percent = self.percent()
+        if percent != None:
+            parts.insert(0,"%.1f%%" % percent)
+            eta = self.eta()
+            if eta != None:
+                eta = int(eta)
+                parts.append("ETA %i:%02i:%02i" % (eta // 3600,eta // 60 % 60,eta % 60))
+        return "%s: %s" % (self.phase,", ".join(parts))
+
+
+class _StatusPrinter(object):
+    """A statusFunction for the command line, which prints the Status
+    to stream at most every interval seconds, and as each phase ends"""
+
+    def __init__(self,stream=None,interval=1.0):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.lastPrinted = time()
+
+    def __call__(self,status):
+        now = time()
+        if status.finished or now - self.lastPrinted >= self.interval:
+            self.lastPrinted = now
+            self.stream.write(str(status) + "\n")
+            self.stream.flush()
+
+
+def _peakMemory():
+    """Returns the peak resident memory of this process in bytes, or
+    None if that can't be told (eg. on Windows)"""
+    if resource == None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+class Profile(object):
+    """Where a conversion spends its time, as given to Cases2kml to be
+    filled in and printed afterwards.
+
+    times holds the seconds spent in each phase, which don't overlap:
+    "read" (tokenising rows and tallying cases by location and day),
+    "dates" (parsing distinct date strings), "aggregate" (bucketing
+    days into periods), "render" (building placemarks), "deflate"
+    (compressing them into the KMZ) and the loading and saving of
+    state.  peaks holds the peak memory, in bytes, reached by the end
+    of each phase, and counts counters such as rows and placemarks."""
+
+    def __init__(self):
+        self.phases = []
+        self.times = {}
+        self.peaks = {}
+        self.counters = []
+        self.counts = {}
+
+    def add(self,phase,seconds):
+        """Adds seconds to the time spent in phase"""
+        if phase not in self.times:
+            self.phases.append(phase)
+            self.times[phase] = 0.0
+        self.times[phase] += seconds
+        self.peaks[phase] = _peakMemory()
+
+    def count(self,counter,n,total=False):
+        """Adds n to counter, or sets it to n if total is True"""
+        if counter not in self.counts:
+            self.counters.append(counter)
+            self.counts[counter] = 0
+        if total:
+            self.counts[counter] = n
+        else:
+            self.counts[counter] += n
+
+    def __str__(self):
+        total = sum(self.times.values())
+        lines = ["%-12s %10s %7s %10s" % ("phase","seconds","%","peak MB")]
+        for phase in self.phases:
+            seconds = self.times[phase]
+            peak = "-"
+            if self.peaks[phase] != None:
+                peak = "%.1f" % (self.peaks[phase] / 1048576.0)
+            lines.append("%-12s %10.3f %7.1f %10s" % (phase,seconds,100.0 * seconds / (total or 1.0),peak))
+        lines.append("%-12s %10.3f" % ("total",total))
+        if self.counters:
+            lines.append("")
+        for counter in self.counters:
+            lines.append("%-12s %18s" % (counter,format(self.counts[counter],",")))
+        return "\n".join(lines)
+
+
+class _ZipEntryWriter(object):
+    """A write-only file object streaming data into a new member of an
+    open ZipFile, compressing it on the fly.
+
+    ZipFile.writestr needs the whole member in memory at once.  Instead
+    the local header is written up front and rewritten with the final
+    sizes and CRC on close(), so the ZipFile must have been opened on a
+    seekable file.  The header always carries zip64 fields if the
+    ZipFile allows them, so that its length can't change.
+
+    If a Profile is given, the time spent compressing is added to its
+    "deflate" phase."""
+
+    def __init__(self,zipFile,arcname,compressType=ZIP_DEFLATED,compressLevel=zlib.Z_DEFAULT_COMPRESSION,profile=None):
+        zinfo = ZipInfo(arcname,localtime()[0:6])
+        zinfo.compress_type = compressType
+        zinfo.external_attr = 0644 << 16
+        zinfo.file_size = 0
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        zinfo.header_offset = zipFile.fp.tell()
+        zipFile._writecheck(zinfo)
+        zipFile._didModify = True
+
+        self.zip64 = zipFile._allowZip64
+        if self.zip64:
+            zinfo.extract_version = max(45,zinfo.extract_version)
+
+        self.compressor = None
+        if compressType == ZIP_DEFLATED:
+            self.compressor = zlib.compressobj(compressLevel,zlib.DEFLATED,-15)
+
+        self.zipFile = zipFile
+        self.zinfo = zinfo
+        self.profile = profile
+        self.fp = zipFile.fp
+        self.fp.write(zinfo.FileHeader(self.zip64))
+
+    def write(self,data):
+        zinfo = self.zinfo
+        zinfo.file_size += len(data)
+        zinfo.CRC = zlib.crc32(data,zinfo.CRC) & 0xffffffff
+        if self.compressor != None:
+            if self.profile != None:
+                started = time()
+                data = self.compressor.compress(data)
+                self.profile.add("deflate",time() - started)
+            else:
+                data = self.compressor.compress(data)
+        zinfo.compress_size += len(data)
+        self.fp.write(data)
+
+    def close(self):
+        zinfo = self.zinfo
+        if self.compressor != None:
+            started = time()
+            data = self.compressor.flush()
+            if self.profile != None:
+                self.profile.add("deflate",time() - started)
+            zinfo.compress_size += len(data)
+            self.fp.write(data)
+            self.compressor = None
+
+        # Go back and fill in the header
+        position = self.fp.tell()
+        self.fp.seek(zinfo.header_offset)
+        self.fp.write(zinfo.FileHeader(self.zip64))
+        self.fp.seek(position)
+
+        self.zipFile.filelist.append(zinfo)
+        self.zipFile.NameToInfo[zinfo.filename] = zinfo
+
+
+def _simpleDateParser(datefmt):
+    """Returns a function converting date strings in datefmt straight
+    into a date, or None if datefmt isn't a plain arrangement of
+    %Y, %m and %d around a single separator (eg. %Y-%m-%d, %d/%m/%Y)"""
+    match = re.match(r"^%([Ymd])([-/.])%([Ymd])\2%([Ymd])$",datefmt)
+    if match is None:
+        return None
+
+    sep = match.group(2)
+    order = [match.group(1),match.group(3),match.group(4)]
+    if sorted(order) != ['Y','d','m']:
+        return None
+    yearPos = order.index('Y')
+    monthPos = order.index('m')
+    dayPos = order.index('d')
+
+    def parse(dateString):
+        fields = dateString.split(sep)
+        if len(fields) != 3 or len(fields[yearPos]) != 4 \
+                or not 0 < len(fields[monthPos]) < 3 \
+                or not 0 < len(fields[dayPos]) < 3 \
+                or not "".join(fields).isdigit():
+            raise ValueError("time data %r does not match format %r" % (dateString,datefmt))
+        return date(int(fields[yearPos]),int(fields[monthPos]),int(fields[dayPos]))
+
+    return parse
+
+
+class _DateParser:
+    """Converts date strings to dates, raising DateError on failure.
+
+    Results are cached on the raw string, since case files repeat the
+    same dates many times over.  Simple numeric formats skip strptime
+    altogether, falling back to it for anything they don't accept so
+    that the same strings are accepted or rejected either way.  parsed
+    counts the strings actually parsed, taking parseTime seconds."""
+
+    def __init__(self,datefmt,maxCache=100000):
+        self.datefmt = datefmt
+        self.maxCache = maxCache
+        self.cache = {}
+        self.simpleParse = _simpleDateParser(datefmt)
+        self.parsed = 0
+        self.parseTime = 0.0
+
+    def __parse(self,dateString):
+        if self.simpleParse != None:
+            try:
+                return self.simpleParse(dateString)
+            except ValueError:
+                pass
+        try:
+            parseDate = strptime(dateString,self.datefmt)
+        except ValueError as err:
+            raise DateError(err.args)
+        return date(*parseDate[0:3])
+
+    def __call__(self,dateString):
+        try:
+            return self.cache[dateString]
+        except KeyError:
+            pass
+
+        started = time()
+        myDate = self.__parse(dateString)
+        self.parseTime += time() - started
+        self.parsed += 1
+        if len(self.cache) >= self.maxCache:
+            self.cache.clear()
+        self.cache[dateString] = myDate
+        return myDate
+
+class _Meshblock(object):
+    """Case counts at one location, by day and by aggregation period.
+
+    Slotted, as there may be hundreds of thousands of these."""
+
+    __slots__ = ('x','y','id','days','cases')
 
     def __init__(self,x,y,id):
         self.x = x
         self.y = y
         self.id = id
+        self.days = {}
         self.cases = {}
 
     def addCase(self,date):
-        if date in self.cases:
-            self.cases[date] += 1
+        if date in self.days:
+            self.days[date] += 1
         else:
-            self.cases[date] = 1
+            self.days[date] = 1
             
     def aggregate(self,aggrDates):
-        pass
+        """Buckets the raw daily case counts into aggregation periods,
+        keyed on period number in the _PeriodTable aggrDates"""
+        self.cases = {}
+        index = aggrDates.index
+        firstDay = aggrDates.firstDay
+        for day,numCases in self.days.iteritems():
+            period = index[day.toordinal() - firstDay]
+            if period in self.cases:
+                self.cases[period] += numCases
+            else:
+                self.cases[period] = numCases
 
     def maxCases(self):
         """Returns the maximum number of cases in any date aggregation"""
@@ -83,164 +443,1188 @@ class _Meshblock:
         return maxNum
 
 
+class _PeriodTable:
+    """Aggregation periods covering minDate to maxDate.
+
+    index maps a day, as an offset from firstDay (minDate's ordinal), to
+    its period number.  starts and ends hold the ISO formatted beginning
+    and end of each period."""
+
+    def __init__(self,aggrUnit,aggrCount,minDate,maxDate):
+        if aggrCount < 1:
+            raise ValueError("Invalid aggregation count!")
+        if aggrUnit == 'D':
+            start = minDate
+            nextStart = lambda start: start + timedelta(days=aggrCount)
+        elif aggrUnit == 'M':
+            start = minDate.replace(day=1)
+            nextStart = lambda start: _addMonths(start,aggrCount)
+        elif aggrUnit == 'Y':
+            start = minDate.replace(month=1,day=1)
+            nextStart = lambda start: start.replace(year=start.year+aggrCount)
+        else:
+            raise ValueError("Invalid aggregation unit!")
+
+        self.firstDay = minDate.toordinal()
+        lastDay = maxDate.toordinal()
+        self.index = []
+        self.starts = []
+        self.ends = []
+
+        period = 0
+        while start.toordinal() <= lastDay:
+            end = nextStart(start)
+            numDays = min(end.toordinal(),lastDay+1) - max(start.toordinal(),self.firstDay)
+            self.index.extend([period] * numDays)
+            self.starts.append(start.isoformat())
+            self.ends.append(end.isoformat())
+            start = end
+            period += 1
+
+
+_ICON = "http://maps.google.com/mapfiles/kml/shapes/shaded_dot.png"
+
+_PLACEMARK = """   <Placemark>
+    <description><![CDATA[Period beginning: %s
+<br>Period ending: %s
+<br>Longitude: %s
+<br>Latitude: %s
+<br>Number of cases: %i]]></description>
+    <TimeSpan>
+     <begin>%s</begin>
+     <end>%s</end>
+    </TimeSpan>
+    <Point>
+     <coordinates>%s</coordinates>
+    </Point>
+    <Style>
+     <IconStyle>
+      <Icon>ICON</Icon>
+      <color>COLOUR</color>
+      <scale>%s</scale>
+     </IconStyle>
+    </Style>
+  </Placemark>
+
+"""
+
+_SHARED_PLACEMARK = _PLACEMARK[:_PLACEMARK.index("    <Style>")] + """    <styleUrl>#%s</styleUrl>
+  </Placemark>
+
+"""
+
+_STYLE = """ <Style id="s%i">
+  <IconStyle>
+   <Icon>ICON</Icon>
+   <color>COLOUR</color>
+   <scale>%s</scale>
+  </IconStyle>
+ </Style>
+"""
+
+
+class _FolderRenderer(object):
+    """Renders a _Meshblock as a KML <Folder> holding a placemark per
+    aggregation period.
+
+    Everything that doesn't vary between placemarks is worked out once:
+    the icon and colour are baked into the placemark template, period
+    start and end strings come from the _PeriodTable, and point scales
+    are cached by number of cases.
+
+    If scaleStep is given, placemarks refer to <Style>s shared at
+    Document level, one per multiple of scaleStep, instead of each
+    carrying their own."""
+
+    def __init__(self,colour,pointMag,periods,scaleStep=None):
+        colour = colour.replace("%","%%")
+        self.scaleStep = scaleStep
+        if scaleStep == None:
+            self.template = _PLACEMARK.replace("ICON",_ICON).replace("COLOUR",colour)
+        else:
+            self.template = _SHARED_PLACEMARK
+            self.styleTemplate = _STYLE.replace("ICON",_ICON).replace("COLOUR",colour)
+        self.pointMag = pointMag
+        self.starts = periods.starts
+        self.ends = periods.ends
+        self.scales = {}
+        # Lone placemarks carry their location's id in the description
+        self.loneTemplate = self.template.replace("<br>Number of cases","<br>Id: %s\n<br>Number of cases",1)
+
+    def __bucket(self,numCases):
+        # Never round down to a zero scale, which would hide the point
+        return max(int(round(sqrt(float(numCases)) * self.pointMag / self.scaleStep)),1)
+
+    def scale(self,numCases):
+        """Returns the scale, or shared style id, for a placemark"""
+        try:
+            return self.scales[numCases]
+        except KeyError:
+            if self.scaleStep == None:
+                scale = str(sqrt(float(numCases)) * self.pointMag)
+            else:
+                scale = "s%i" % self.__bucket(numCases)
+            self.scales[numCases] = scale
+            return scale
+
+    def styles(self,caseCounts):
+        """Returns the shared <Style>s needed for placemarks with the
+        numbers of cases in caseCounts"""
+        buckets = sorted(set([self.__bucket(numCases) for numCases in caseCounts]))
+        return "".join([self.styleTemplate % (bucket,str(bucket * self.scaleStep)) for bucket in buckets])
+
+    def placemark(self,x,y,id,period,numCases):
+        """Renders a placemark outside of a location <Folder>"""
+        start = self.starts[period]
+        end = self.ends[period]
+        return self.loneTemplate % (start,end,"%f" % x,"%f" % y,id,numCases,start,end,
+                                    "%s,%s,0" % (x,y),self.scale(numCases))
+
+    def folder(self,x,y,id,cases):
+        """Renders the placemarks at x,y, cases being an iterable of
+        (period number, number of cases) pairs"""
+        template = self.template
+        starts = self.starts
+        ends = self.ends
+        scales = self.scales
+        lon = "%f" % x
+        lat = "%f" % y
+        coordinates = "%s,%s,0" % (x,y)
+
+        parts = [" <Folder>\n  <name>%s</name>\n" % id]
+        for period,numCases in cases:
+            start = starts[period]
+            end = ends[period]
+            scale = scales.get(numCases) or self.scale(numCases)
+            parts.append(template % (start,end,lon,lat,numCases,start,end,coordinates,scale))
+        parts.append(" </Folder>\n")
+        return "".join(parts)
+
+
+def _kmlHeader(docName):
+    return """<?xml version="1.0" encoding="us-ascii"?>
+<kml xmlns="http://earth.google.com/kml/2.1">
+<Document>\n <name>""" + docName + "</name>\n"
+
+
+_KML_FOOTER = "</Document>\n</kml>"
+
+_REGION = """ <Region>
+  <LatLonAltBox>
+   <north>%r</north>
+   <south>%r</south>
+   <east>%r</east>
+   <west>%r</west>
+  </LatLonAltBox>
+  <Lod>
+   <minLodPixels>%i</minLodPixels>
+   <maxLodPixels>-1</maxLodPixels>
+  </Lod>
+ </Region>
+"""
+
+_TILE_LINK = """ <NetworkLink>
+  <name>%s</name>
+%s  <Link>
+   <href>%s</href>
+   <viewRefreshMode>onRegion</viewRefreshMode>
+  </Link>
+ </NetworkLink>
+"""
+
+_PERIOD_LINK = """ <NetworkLink>
+  <name>%s</name>
+  <TimeSpan>
+   <begin>%s</begin>
+   <end>%s</end>
+  </TimeSpan>
+  <Link>
+   <href>%s</href>
+  </Link>
+ </NetworkLink>
+"""
+
+_MAX_TILE_DEPTH = 24
+
+
+class _Tile(object):
+    """A node of a quadtree over the meshblocks.  Leaves hold the keys
+    of their meshblocks, other tiles up to four child tiles."""
+
+    def __init__(self,name,bounds):
+        self.name = name
+        self.bounds = bounds
+        self.lockeys = []
+        self.children = []
+
+    def region(self,minLodPixels):
+        west,south,east,north = self.bounds
+        return _REGION % (north,south,east,west,minLodPixels)
+
+    def link(self,minLodPixels):
+        return _TILE_LINK % (self.name,self.region(minLodPixels),self.name + ".kml")
+
+
+def _quadtree(points,bounds,maxPoints,name="r",depth=0):
+    """Builds a quadtree of _Tiles over points, a list of (x,y,lockey),
+    splitting bounds (west,south,east,north) into quarters until no
+    tile holds more than maxPoints points"""
+    tile = _Tile(name,bounds)
+    if len(points) <= maxPoints or depth == _MAX_TILE_DEPTH:
+        tile.lockeys = [lockey for x,y,lockey in points]
+        return tile
+
+    west,south,east,north = bounds
+    midX = (west + east) / 2.0
+    midY = (south + north) / 2.0
+    quadrants = [[],[],[],[]]
+    for point in points:
+        quadrants[(point[0] >= midX) + 2 * (point[1] >= midY)].append(point)
+
+    quadrantBounds = [(west,south,midX,midY),(midX,south,east,midY),
+                      (west,midY,midX,north),(midX,midY,east,north)]
+    for quadrant in xrange(4):
+        if quadrants[quadrant]:
+            tile.children.append(_quadtree(quadrants[quadrant],quadrantBounds[quadrant],
+                                           maxPoints,name + str(quadrant),depth + 1))
+    return tile
+
+
+_workerRenderer = None
+
+def _initRenderer(renderer):
+    """Worker process initialiser for parallel serialisation"""
+    global _workerRenderer
+    _workerRenderer = renderer
+
+
+def _renderFolders(folders):
+    """Worker process function: renders a batch of (x,y,id,cases)
+    folders"""
+    folder = _workerRenderer.folder
+    return "".join([folder(*args) for args in folders])
+
+
+def _tally(cells,numCells):
+    """Returns the distinct values in the integer array cells, all less
+    than numCells, and the number of times each occurs"""
+    if numCells <= 4 * len(cells):
+        counts = numpy.bincount(cells,minlength=numCells)
+        cells = numpy.flatnonzero(counts)
+        return cells,counts[cells]
+    return numpy.unique(cells,return_counts=True)
+
+
+def _countArrays(locations,ordinals,periods):
+    """Vectorised counterpart of _Meshblock.addCase and aggregate.
+
+    Takes the location number and date ordinal of every case, as int
+    arrays, and returns a (location, day offset, count) and a
+    (location, period, count) table of numpy arrays."""
+    numDays = len(periods.index)
+    numPeriods = len(periods.starts)
+    locations = numpy.frombuffer(locations,dtype=numpy.int32).astype(numpy.int64)
+    days = numpy.frombuffer(ordinals,dtype=numpy.int32) - periods.firstDay
+
+    cells,dayCounts = _tally(locations * numDays + days,(locations.max()+1) * numDays)
+    dayLocations = cells // numDays
+    dayOffsets = cells % numDays
+
+    cells = dayLocations * numPeriods + numpy.asarray(periods.index,dtype=numpy.int64)[dayOffsets]
+    cells,inverse = numpy.unique(cells,return_inverse=True)
+    periodCounts = numpy.bincount(inverse,weights=dayCounts).astype(numpy.int64)
+
+    return (dayLocations,dayOffsets,dayCounts),(cells // numPeriods,cells % numPeriods,periodCounts)
+
+
+class _GridBinner(object):
+    """Snaps longitude/latitude to the centres of a grid of cells
+    cellWidth by cellHeight degrees, numbered by an integer key.  If
+    the cells don't divide 360 by 180 degrees, the last column and row
+    are narrower, and centred on what they cover."""
+
+    def __init__(self,cellWidth,cellHeight=None):
+        if cellHeight == None:
+            cellHeight = cellWidth
+        self.cellWidth = float(cellWidth)
+        self.cellHeight = float(cellHeight)
+        if self.cellWidth <= 0 or self.cellHeight <= 0:
+            raise ValueError("Grid cells must have a positive size")
+        self.columns = int(ceil(360.0 / self.cellWidth))
+        self.rows = int(ceil(180.0 / self.cellHeight))
+
+    def cell(self,x,y):
+        # Longitudes wrap, so that 180 is the same as -180, and latitude
+        # 90 falls in the top row
+        column = min(int(floor(((x + 180.0) % 360.0) / self.cellWidth)),self.columns - 1)
+        row = min(int(floor((y + 90.0) / self.cellHeight)),self.rows - 1)
+        return row * self.columns + column
+
+    def cells(self,x,y):
+        """As cell, for numpy arrays of longitudes and latitudes"""
+        columns = numpy.floor(numpy.mod(x + 180.0,360.0) / self.cellWidth).astype(numpy.int64)
+        rows = numpy.floor((y + 90.0) / self.cellHeight).astype(numpy.int64)
+        return numpy.minimum(rows,self.rows - 1) * self.columns + numpy.minimum(columns,self.columns - 1)
+
+    def centre(self,cell):
+        row,column = divmod(cell,self.columns)
+        x = (column + 0.5) * self.cellWidth - 180.0
+        y = (row + 0.5) * self.cellHeight - 90.0
+        # The last column and row may be cut short
+        if column == self.columns - 1:
+            x = (column * self.cellWidth + 360.0) / 2.0 - 180.0
+        if row == self.rows - 1:
+            y = (row * self.cellHeight + 180.0) / 2.0 - 90.0
+        return x,y
+
+    def label(self,cell):
+        return "%.6f,%.6f" % self.centre(cell)
+
+
+_GEOHASH_DIGITS = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+class _GeohashBinner(_GridBinner):
+    """Snaps longitude/latitude to the centres of geohash cells with
+    the given number of characters"""
+
+    def __init__(self,precision):
+        if precision < 1:
+            raise ValueError("Geohash precision must be at least 1")
+        self.precision = precision
+        self.lonBits = (5 * precision + 1) // 2
+        self.latBits = 5 * precision // 2
+        _GridBinner.__init__(self,360.0 / 2**self.lonBits,180.0 / 2**self.latBits)
+
+    def label(self,cell):
+        row,column = divmod(cell,self.columns)
+        geohash = 0
+        for bit in xrange(5 * self.precision):
+            geohash <<= 1
+            if bit % 2 == 0:
+                geohash |= (column >> (self.lonBits - 1 - bit // 2)) & 1
+            else:
+                geohash |= (row >> (self.latBits - 1 - bit // 2)) & 1
+        digits = []
+        for i in xrange(self.precision):
+            digits.append(_GEOHASH_DIGITS[geohash & 31])
+            geohash >>= 5
+        return "".join(reversed(digits))
+
+
+def _makeBinner(gridSize,geohash):
+    """Returns the binner for the readCSV options gridSize and geohash,
+    or None if locations aren't to be binned"""
+    if gridSize != None and geohash != None:
+        raise ValueError("Only one of gridSize and geohash may be given")
+    if gridSize != None:
+        return _GridBinner(gridSize)
+    if geohash != None:
+        return _GeohashBinner(int(geohash))
+    return None
+
+
+def _csvReader(csvFile,quoteChar,delimChar):
+    """Returns a csv.reader over csvFile, quoting fields only if a
+    quoteChar is given"""
+    isQuoted = csv.QUOTE_NONE
+    if quoteChar != "":
+        isQuoted = csv.QUOTE_MINIMAL
+    return csv.reader(csvFile,quoting=isQuoted,quotechar=str(quoteChar),delimiter=str(delimChar))
+
+
+class _WholeLines(object):
+    """Iterates over the lines of csvFile, leaving out a last line with
+    no newline, which may still be being written.  partial is then its
+    length, so that csvFile.tell() - partial is the end of the last
+    whole line."""
+
+    def __init__(self,csvFile):
+        self.csvFile = csvFile
+        self.partial = 0
+
+    def __iter__(self):
+        for line in self.csvFile:
+            if not line.endswith("\n"):
+                self.partial = len(line)
+                return
+            yield line
+
+
+def _lastLineEnd(csvFile,size):
+    """Returns the offset just past the last newline in the first size
+    bytes of csvFile, or 0 if there is none"""
+    position = size
+    while position > 0:
+        blockStart = max(position - 65536,0)
+        csvFile.seek(blockStart)
+        newline = csvFile.read(position - blockStart).rfind("\n")
+        if newline >= 0:
+            return blockStart + newline + 1
+        position = blockStart
+    return 0
+
+
+_MAPPED_BLOCK = 4 * 1024 * 1024
+
+
+def _mapFile(csvFile,delimChar,numFields):
+    """Memory maps an open, unquoted CSV file for _MappedReader, or
+    returns None if it is empty or its header shows no more than
+    numFields columns, as csv.reader is as quick splitting whole rows"""
+    if os.fstat(csvFile.fileno()).st_size == 0:
+        return None
+    data = mmap.mmap(csvFile.fileno(),0,access=mmap.ACCESS_READ)
+    headerEnd = data.find("\n")
+    if headerEnd == -1 or data[:headerEnd].count(str(delimChar)) < numFields:
+        data.close()
+        return None
+    return data
+
+
+class _MappedReader(object):
+    """Stands in for _csvReader on unquoted CSV data, eg. an mmap,
+    between offsets start and end: rows are only split into their first
+    numFields fields, with the rest of the line left in one last field,
+    sparing a string per unused column.  Lines are copied out a block
+    at a time, position being the end of the latest block."""
+
+    def __init__(self,data,start,end,delimChar,numFields):
+        self.data = data
+        self.position = start
+        self.end = end
+        self.delimChar = str(delimChar)
+        self.numFields = numFields
+
+    def __lines(self):
+        data = self.data
+        start = self.position
+        end = self.end
+        while start < end:
+            stop = min(start + _MAPPED_BLOCK,end)
+            if stop < end:
+                stop = data.rfind("\n",start,stop) + 1 or end
+            self.position = stop
+            for line in data[start:stop].splitlines():
+                yield line
+            start = stop
+
+    def __iter__(self):
+        delimChar = self.delimChar
+        numFields = self.numFields
+        return (line.split(delimChar,numFields) for line in self.__lines())
+
+
+def _inputPosition(filename,csvFile,reader):
+    """Returns a function telling how far into filename reading has got,
+    in bytes, or None if that can't be told (bzip2 and xz files)"""
+    if isinstance(reader,_MappedReader):
+        return lambda: reader.position
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.gz':
+        return csvFile.raw.fileobj.tell
+    if extension in _COMPRESSED_EXTENSIONS:
+        return None
+    return csvFile.tell
+
+
+class _ReadProgress(object):
+    """Wraps readCSV's progressUpdateFunc, which is called every thousand
+    rows, to also report how far through the input file reading has
+    got as a Status to statusFunction.  position() gives the byte
+    offset reached, between start and end, if it can be told."""
+
+    def __init__(self,progressUpdateFunc,statusFunction,position=None,start=0,end=None):
+        self.progressUpdateFunc = progressUpdateFunc
+        self.statusFunction = statusFunction
+        self.position = position
+        self.start = start
+        totalBytes = None
+        if end != None:
+            totalBytes = max(end - start,0)
+        self.status = Status("read",totalBytes)
+        self.calls = 0
+
+    def __call__(self,*args):
+        if self.progressUpdateFunc != None:
+            self.progressUpdateFunc(*args)
+        if len(args) > 0:
+            return
+
+        # The first call comes before any rows are tallied
+        self.calls += 1
+        bytesRead = None
+        if self.position != None:
+            bytesRead = self.position() - self.start
+        self.update(1000 * (self.calls - 1),bytesRead)
+
+    def update(self,rows,bytesRead=None):
+        status = self.status
+        status.rows = rows
+        if bytesRead != None:
+            status.bytesRead = bytesRead
+        status.elapsed = time() - status.started
+        if self.statusFunction != None:
+            self.statusFunction(status)
+
+    def finish(self,rows):
+        self.status.finished = True
+        self.update(rows,self.status.totalBytes)
+
+
+def _numFields(fieldMap,binner):
+    """The number of leading fields of a row that are used, including
+    the id field of unbinned locations"""
+    numFields = max(fieldMap.itervalues()) + 1
+    if binner == None:
+        numFields = max(numFields,4)
+    return numFields
+
+
+_COMPRESSED_EXTENSIONS = ('.gz','.bz2','.xz')
+
+
+def _isCompressed(filename):
+    return os.path.splitext(filename)[1].lower() in _COMPRESSED_EXTENSIONS
+
+
+def _openInput(filename):
+    """Opens a CSV file for reading, decompressing it as it is read if
+    its name ends in .gz, .bz2 or .xz"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.gz':
+        # GzipFile.readline is pure Python, so buffer it
+        return io.BufferedReader(gzip.open(filename,"rb"),1024*1024)
+    if extension == '.bz2':
+        return bz2.BZ2File(filename,"rb",1024*1024)
+    if extension == '.xz':
+        if lzma == None:
+            raise ImportError("Reading .xz files requires the lzma module (backports.lzma on Python 2)")
+        return io.BufferedReader(lzma.LZMAFile(filename,"rb"),1024*1024)
+    return open(filename,"rb")
+
+
+def _inputCheck(filename,offset,blockSize=65536):
+    """Returns a digest of the first blockSize bytes of filename and,
+    unless it is compressed, of the blockSize bytes before offset.  If
+    it still matches when resuming a read from offset, the file has
+    only been appended to."""
+    inputFile = _openInput(filename)
+    try:
+        digest = hashlib.sha1(inputFile.read(min(offset,blockSize)))
+        if not _isCompressed(filename):
+            # Compressed files can't be seeked without decompressing
+            tail = max(offset - blockSize,0)
+            inputFile.seek(tail)
+            digest.update(inputFile.read(offset - tail))
+    finally:
+        inputFile.close()
+    return digest.hexdigest()
+
+
+def _readHeader(filename,quoteChar,delimChar):
+    """Returns the column names in the header row of a CSV file"""
+    csvFile = _openInput(filename)
+    header = _csvReader(csvFile,quoteChar,delimChar).next()
+    csvFile.close()
+    return header
+
+
+def _resolveFieldMap(fieldMap,names):
+    """Returns fieldMap with any column names replaced by their index
+    in names"""
+    names = [name.strip() for name in names]
+    resolved = {}
+    for key,field in fieldMap.iteritems():
+        if isinstance(field,basestring):
+            if field not in names:
+                raise ValueError("No column named '%s'" % field)
+            field = names.index(field)
+        resolved[key] = field
+    return resolved
+
+
+def _hasNamedFields(fieldMap):
+    return len([field for field in fieldMap.itervalues() if isinstance(field,basestring)]) > 0
+
+
+def _newMeshblock(row,xField,yField,lockey,binner):
+    """Creates the _Meshblock for the location first seen in row"""
+    if binner == None:
+        id = None
+        if len(row) > 3:
+            id = row[3]
+        return _Meshblock(float(row[xField]),float(row[yField]),id)
+
+    x,y = binner.centre(lockey)
+    return _Meshblock(x,y,binner.label(lockey))
+
+
+def _tallyRows(reader,meshblocks,fieldMap,parseDate,progressUpdateFunc=None,binner=None):
+    """Tallies the cases in reader by location and day into meshblocks,
+    returning the number of rows.  Locations are keyed on their
+    coordinate strings, or on their grid cell if a binner is given."""
+    xField = fieldMap['x']
+    yField = fieldMap['y']
+    dateField = fieldMap['date']
+
+    counter = 0
+    for row in reader:
+        if progressUpdateFunc != None and (counter % 1000) == 0:
+            progressUpdateFunc()
+        
+        counter += 1
+
+        myDate = parseDate(row[dateField])
+
+        if binner == None:
+            lockey = row[xField]+row[yField]
+        else:
+            lockey = binner.cell(float(row[xField]),float(row[yField]))
+            
+        meshblock = meshblocks.get(lockey)
+        if meshblock == None:
+            meshblock = meshblocks[lockey] = _newMeshblock(row,xField,yField,lockey,binner)
+        meshblock.addCase(myDate)
+
+    return counter
+
+
+def _chunkOffsets(filename,numChunks,start=None,wholeLines=False):
+    """Splits the rows of a CSV file, ie. everything after the header or
+    from offset start, into at most numChunks byte ranges starting at
+    line boundaries.  Returns the list of boundary offsets, including
+    the end of file, or with wholeLines the end of its last newline."""
+    csvFile = open(filename,"rb")
+    if start == None:
+        csvFile.readline() # Skip header
+        start = csvFile.tell()
+    size = os.fstat(csvFile.fileno()).st_size
+    if wholeLines:
+        size = max(_lastLineEnd(csvFile,size),start)
+
+    offsets = [start]
+    for chunk in xrange(1,numChunks):
+        csvFile.seek(start + (size - start) * chunk // numChunks - 1)
+        csvFile.readline()
+        offset = csvFile.tell()
+        if offsets[-1] < offset < size:
+            offsets.append(offset)
+    offsets.append(size)
+
+    csvFile.close()
+    return offsets
+
+
+def _readChunk(args):
+    """Worker process function: tallies the cases by location and day
+    in one byte range of a CSV file.
+
+    Rather than _Meshblocks, which are slow to send back to the parent,
+    returns the tallies packed by _packTallies."""
+    filename,start,end,fieldMap,datefmt,quoteChar,delimChar,gridSize,geohash = args
+    binner = _makeBinner(gridSize,geohash)
+
+    csvFile = open(filename,"rb")
+    numFields = _numFields(fieldMap,binner)
+    data = None
+    if quoteChar == "":
+        data = _mapFile(csvFile,delimChar,numFields)
+    if data != None:
+        reader = _MappedReader(data,start,end,delimChar,numFields)
+    else:
+        csvFile.seek(start)
+        reader = _csvReader(StringIO(csvFile.read(end - start)),quoteChar,delimChar)
+    csvFile.close()
+
+    meshblocks = {}
+    _tallyRows(reader,meshblocks,fieldMap,_DateParser(datefmt),None,binner)
+    return _packTallies(meshblocks)
+
+
+def _replaceFile(source,target):
+    """Renames source to target, replacing it if it exists"""
+    try:
+        os.rename(source,target)
+    except OSError:
+        # Windows won't rename over an existing file
+        if os.name != 'nt' or not os.path.exists(target):
+            raise
+        os.remove(target)
+        os.rename(source,target)
+
+
+def _packTallies(meshblocks):
+    """Packs the tallies of cases by location and day in meshblocks as
+    the location keys, (x,y) pairs and ids, plus int arrays of the
+    location number, date ordinal and case count of each location-day.
+    A C long may only have 32 bits, so the arrays are of C ints rather
+    than one cell number."""
+    lockeys = meshblocks.keys()
+    coords = array('d')
+    ids = []
+    locs = array('i')
+    ordinals = array('i')
+    counts = array('i')
+    for loc,lockey in enumerate(lockeys):
+        meshblock = meshblocks[lockey]
+        coords.append(meshblock.x)
+        coords.append(meshblock.y)
+        ids.append(meshblock.id)
+        for day,numCases in meshblock.days.iteritems():
+            locs.append(loc)
+            ordinals.append(day.toordinal())
+            counts.append(numCases)
+
+    return lockeys,coords.tostring(),ids,locs.tostring(),ordinals.tostring(),counts.tostring()
+
+
+# Saved state is a line of JSON, followed by the packed tallies as
+# little-endian arrays, rather than a pickle, so that loading a state or
+# cache file from a shared directory can't run code
+_STATE_VERSION = 3
+
+
+def _littleEndian(data,typecode):
+    """Converts packed array data between native and little-endian
+    byte order"""
+    if sys.byteorder == 'little':
+        return data
+    packed = array(typecode,data)
+    packed.byteswap()
+    return packed.tostring()
+
+
+def _fromJSON(value):
+    """Undoes what JSON does to saved state: strings, written as
+    latin-1 so that any bytes survive, come back as unicode, and tuples
+    come back as lists"""
+    if isinstance(value,unicode):
+        try:
+            return value.encode("latin-1")
+        except UnicodeError:
+            return value
+    if isinstance(value,list):
+        return tuple([_fromJSON(item) for item in value])
+    if isinstance(value,dict):
+        return dict([(_fromJSON(key),_fromJSON(item)) for key,item in value.iteritems()])
+    return value
+
+
+def _mergeTallies(meshblocks,tallies,dates):
+    """Adds packed tallies, as returned by _readChunk, into meshblocks.
+    Locations already in meshblocks keep their coordinates and id.
+    dates is a cache of date ordinal to date, shared between calls."""
+    lockeys,coords,ids,locs,ordinals,counts = tallies
+    coords = array('d',coords)
+
+    chunkDays = []
+    for loc,lockey in enumerate(lockeys):
+        if lockey not in meshblocks:
+            meshblocks[lockey] = _Meshblock(coords[2*loc],coords[2*loc+1],ids[loc])
+        chunkDays.append(meshblocks[lockey].days)
+
+    for loc,ordinal,numCases in izip(array('i',locs),array('i',ordinals),array('i',counts)):
+        day = dates.get(ordinal)
+        if day == None:
+            day = dates[ordinal] = date.fromordinal(ordinal)
+        days = chunkDays[loc]
+        if day in days:
+            days[day] += numCases
+        else:
+            days[day] = numCases
+
+
+class NpyColumns(object):
+    """Columnar input for Cases2kml.readColumns: a directory holding a
+    NumPy .npy file per column, eg. x.npy, y.npy and date.npy, which
+    are memory mapped rather than read in.  Columns are numbered in
+    order of name.
+
+    Other columnar formats can be read by handing readColumns any
+    object with a names list and a column(name) method returning an
+    array of the column's values."""
+
+    def __init__(self,directory):
+        if numpy == None:
+            raise ImportError("Reading .npy columns requires numpy to be installed")
+        self.directory = directory
+        self.names = sorted([name[:-4] for name in os.listdir(directory) if name.endswith(".npy")])
+
+    def column(self,name):
+        return numpy.load(os.path.join(self.directory,name + ".npy"),mmap_mode='r')
+
+
+_EPOCH_ORDINAL = date(1970,1,1).toordinal()
+
+
+def _dateOrdinals(column,datefmt):
+    """Returns the date ordinals of a column of numpy datetime64s, or
+    of date strings in format datefmt, parsing each distinct string
+    once"""
+    column = numpy.asarray(column)
+    if column.dtype.kind == 'M':
+        return column.astype('datetime64[D]').astype(numpy.int64) + _EPOCH_ORDINAL
+
+    values,inverse = numpy.unique(column,return_inverse=True)
+    parseDate = _DateParser(datefmt)
+    ordinals = [parseDate(value if isinstance(value,basestring) else str(value)).toordinal() for value in values.tolist()]
+    return numpy.array(ordinals,dtype=numpy.int64)[inverse]
+
+
 class Cases2kml:
 
-    def __init__(self,aggrUnit,aggrCount,pointMag,colour):
+    def __init__(self,aggrUnit,aggrCount,pointMag,colour,scaleStep=None,statusFunction=None,profile=None):
+        """scaleStep, if given, rounds point scales to multiples of
+        scaleStep so that placemarks can share Document level styles.
+        statusFunction, if given, is called now and then with a Status
+        while reading and writing.  profile, if given, is a Profile to
+        add the time spent in each phase, and counts, to."""
         self.aggrUnit = aggrUnit
         self.aggrCount = aggrCount
         self.pointMag = float(pointMag)
         self.colour = colour
-        
-    def __placemark(self,x,y,id,date,numCases):
-        """Serializes a placemark"""
-        
-        pmString = StringIO()
+        self.scaleStep = scaleStep
+        if scaleStep != None:
+            self.scaleStep = float(scaleStep)
+        self.meshblocks = {}
+        self.offset = 0
+        self.inputOptions = None
+        self.inputName = None
+        self.inputCheck = None
+        self.statusFunction = statusFunction
+        self.profile = profile
+        self.__writing = None
 
-        if self.aggrUnit == 'D':
-            end = date + timedelta(days=self.aggrCount)
-            
-        elif self.aggrUnit == 'M':
-            end = _addMonths(date,self.aggrCount)
 
-        elif self.aggrUnit == 'Y':
-            end = date.replace(year=date.year+self.aggrCount)
-            
-        else:
-            raise ValueError("Invalid aggregation unit!")
-        
+    def __profiled(self,phase,started,excluded=0.0):
+        """Adds the seconds since started, less the excluded seconds
+        spent in other phases, to phase of the profile, if any"""
+        if self.profile != None:
+            self.profile.add(phase,time() - started - excluded)
 
-        description = """Period beginning: %s
-<br>Period ending: %s
-<br>Longitude: %f
-<br>Latitude: %f
-<br>Number of cases: %i""" % (date.isoformat(), end.isoformat(), x, y, numCases)
 
-        pointSize = sqrt(float(numCases))
+    def __profileTime(self,phase):
+        """Returns the seconds profiled in phase so far"""
+        if self.profile == None:
+            return 0.0
+        return self.profile.times.get(phase,0.0)
+
         
-        pmString.write( "   <Placemark>\n" )
-        pmString.write( "    <description><![CDATA[" + description + "]]></description>\n" )
-        pmString.write( "    <TimeSpan>\n" )
-        pmString.write( "     <begin>" + date.isoformat() + "</begin>\n" )
-        pmString.write( "     <end>" + end.isoformat() + "</end>\n" )
-        pmString.write( "    </TimeSpan>\n" )
-        pmString.write( "    <Point>\n" )
-        pmString.write( "     <coordinates>" + str(x) + "," + str(y) + ",0</coordinates>\n" )
-        pmString.write( "    </Point>\n" )
-        pmString.write( "    <Style>\n" )
-        pmString.write( "     <IconStyle>\n" )
-        pmString.write( "      <Icon>http://maps.google.com/mapfiles/kml/shapes/shaded_dot.png</Icon>\n" )
-        pmString.write( "      <color>" + self.colour + "</color>\n" )
-        pmString.write( "      <scale>" + str(pointSize*self.pointMag) + "</scale>\n" )
-        pmString.write( "     </IconStyle>\n" )
-        pmString.write( "    </Style>\n" )
-        pmString.write( "  </Placemark>\n" )
-
-        return pmString.getvalue()
-
-
-
-    def readCSV(self,inputfile, fieldMap, datefmt="%Y-%m-%d", quoteChar="", delimChar=",",progressUpdateFunc=None):
+    def __aggregate(self):
+        """Buckets the tallies of cases by day into aggregation periods"""
+        started = time()
+
+        # Get date range
+        self.maxDate = date.min
+        self.minDate = date.max
+        for key,meshblock in self.meshblocks.iteritems():
+            self.minDate = min(self.minDate,min(meshblock.days))
+            self.maxDate = max(self.maxDate,max(meshblock.days))
+
+        # Bucket days into aggregation periods
+        self.periods = _PeriodTable(self.aggrUnit,self.aggrCount,self.minDate,self.maxDate)
+        for key,meshblock in self.meshblocks.iteritems():
+            meshblock.aggregate(self.periods)
+        self.__profiled("aggregate",started)
+
+
+    def __readChunks(self,filename,inputOptions,workers,progress,start=None,wholeLines=False):
+        """Tallies cases by location and day, farming out chunks of the
+        file to a pool of worker processes and merging their tallies.
+        inputOptions are readCSV's fieldMap, datefmt, quoteChar,
+        delimChar, gridSize and geohash, and progress a _ReadProgress.
+        Returns the offset of the end of the file, or with wholeLines of
+        its last newline."""
+        numChunks = max(workers * 4,os.path.getsize(filename) // (64 * 1024 * 1024))
+        offsets = _chunkOffsets(filename,numChunks,start,wholeLines)
+        tasks = [(filename,start,end) + inputOptions
+                 for start,end in izip(offsets[:-1],offsets[1:])]
+
+        meshblocks = self.meshblocks
+        dates = {}
+        pool = Pool(workers)
+        try:
+            # Chunks come back in file order, so each location keeps the
+            # coordinates and id of its first row, as in a serial read
+            rows = 0
+            for tallies,end in izip(pool.imap(_readChunk,tasks),offsets[1:]):
+                _mergeTallies(meshblocks,tallies,dates)
+                rows += sum(array('i',tallies[5]))
+                if progress.progressUpdateFunc != None:
+                    progress.progressUpdateFunc()
+                progress.update(rows,end - progress.start)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        progress.finish(rows)
+        return offsets[-1]
+
+
+    def __countArrays(self,locList,locations,ordinals):
+        """Fills in the days and cases of the _Meshblocks in locList from
+        int32 arrays of the location number and date ordinal of every
+        case"""
+        started = time()
+        ordinals = numpy.frombuffer(ordinals,dtype=numpy.int32)
+        if len(ordinals) == 0:
+            self.periods = _PeriodTable(self.aggrUnit,self.aggrCount,self.minDate,self.maxDate)
+            return
+
+        # Get date range
+        self.minDate = date.fromordinal(int(ordinals.min()))
+        self.maxDate = date.fromordinal(int(ordinals.max()))
+
+        # Count cases by day and aggregation period
+        self.periods = _PeriodTable(self.aggrUnit,self.aggrCount,self.minDate,self.maxDate)
+        dayTable,periodTable = _countArrays(locations,ordinals,self.periods)
+
+        days = [date.fromordinal(self.periods.firstDay + i) for i in xrange(len(self.periods.index))]
+        for loc,day,numCases in izip(*[column.tolist() for column in dayTable]):
+            locList[loc].days[days[day]] = numCases
+        for loc,period,numCases in izip(*[column.tolist() for column in periodTable]):
+            locList[loc].cases[period] = numCases
+        self.__profiled("aggregate",started)
+
+
+    def readCSV(self,inputfile, fieldMap, datefmt="%Y-%m-%d", quoteChar="", delimChar=",",progressUpdateFunc=None,workers=1,append=False,gridSize=None,geohash=None,wholeLines=False):
         """csv2kml converts a CSV file of event times into a time-aggregated
     KML file. Command line options are:
-        inputFile: CSV file
-        fielaMap: a dictionary of x,y,date (keys) and col number
+        inputFile: CSV file name, or an open file object or other
+                   iterable of lines (eg. sys.stdin).  Names ending
+                   in .gz, .bz2 or .xz are decompressed as they are
+                   read, in which case a single worker is used.
+        fielaMap: a dictionary of x,y,date (keys) and col number, or
+                  col name as given in the header row
         aggr: the aggregation level [D,M,Y].
         datefmt: the Python time.strftime() format code.
+        workers: the number of processes to read a CSV file name with.
+                 Chunks of the file are split at newlines, so quoted
+                 fields must not contain line breaks.
+        append: add to the existing tallies, eg. from loadState(),
+                rather than starting afresh.  A CSV file name is read
+                from where the last read of it finished, raising
+                ValueError if it isn't the same file, appended to.
+        wholeLines: leave a last line with no newline unread, as it may
+                    still be being written, for the next append to
+                    pick up.  Use this when keeping state for a file
+                    that is appended to.
+        gridSize: if given, locations are snapped to the centres of
+                  a grid of gridSize degree squares, so the number of
+                  placemarks is bounded by the grid rather than the
+                  number of distinct coordinates.
+        geohash: as gridSize, but snapping to geohash cells with this
+                 many characters, which also become the folder names.
+
+    The statusFunction given to the constructor is also called now and
+    then, with a Status, whose percent() tells how much of a CSV file
+    name has been read, by byte offset (not for .bz2 or .xz files).
+    Any of the callbacks may raise ConversionCancelled, or any other
+    exception, to stop reading part way.
+
+    The input is read in a single pass: case counts are tallied per
+    location and day, then bucketed into aggregation periods once the
+    earliest date is known.
         """
 
-        self.meshblocks = {}
+        binner = _makeBinner(gridSize,geohash)
+        inputOptions = (fieldMap,datefmt,quoteChar,delimChar,gridSize,geohash)
+        if not append:
+            self.meshblocks = {}
+            self.offset = 0
+            self.inputName = None
+            self.inputCheck = None
+        elif self.inputOptions != None and inputOptions != self.inputOptions:
+            raise ValueError("Cannot append using different CSV settings to the existing tallies")
+        self.inputOptions = inputOptions
+        start = None
+        if append and self.offset > 0:
+            start = self.offset
         
-        xField = fieldMap['x']
-        yField = fieldMap['y']
-        dateField = fieldMap['date']
         self.maxDate = date.min
         self.minDate = date.max
-        
-        #Quoting
-        isQuoted = csv.QUOTE_NONE
-        if quoteChar != "":
-            isQuoted = csv.QUOTE_MINIMAL
 
-        # Open CSV file
-        csvFile = open(inputfile,"rb")
-        
-        # First pass - get max and min dates
-        reader = csv.reader(csvFile,quoting=isQuoted,quotechar=str(quoteChar),delimiter=str(delimChar))
-        reader.next() # Skip header
-        progressUpdateFunc("Inspecting file....")
-        
-        counter = 0
-        for row in reader:
-            if progressUpdateFunc != None and (counter % 1000) == 0:
-                progressUpdateFunc()
-                
-            counter += 1
-            
-            try:
-                parseDate = strptime(row[dateField],datefmt)
-            except ValueError as err:
-                raise DateError(err.args)
-            
-            myDate = date(*parseDate[0:3])
-                
-            self.maxDate = max(myDate,self.maxDate)
-            self.minDate = min(myDate,self.minDate)
-            
-        # Reset file
-        csvFile.seek(0)
-        
-        # Second pass - get the data in
-        reader = csv.reader(csvFile,quoting=isQuoted,quotechar=str(quoteChar),delimiter=str(delimChar))
-        reader.next() # Skip header
-        progressUpdateFunc("Reading data....")
-        for row in reader:
-            if progressUpdateFunc != None and (counter % 1000) == 0:
-                progressUpdateFunc()
-            
-            counter += 1
+        compressed = isinstance(inputfile,basestring) and _isCompressed(inputfile)
+        if start != None and isinstance(inputfile,basestring) and not compressed and os.path.getsize(inputfile) < start:
+            raise ValueError("'%s' is shorter than when last read, has it been replaced?" % inputfile)
+        if start != None and isinstance(inputfile,basestring):
+            if self.inputName != None and os.path.abspath(inputfile) != self.inputName:
+                raise ValueError("The tallies were read from '%s', not '%s'" % (self.inputName,inputfile))
+            if self.inputCheck != None and _inputCheck(inputfile,start) != self.inputCheck:
+                raise ValueError("'%s' has changed since it was last read, rather than being appended to" % inputfile)
+        bytesIn = None
+        if isinstance(inputfile,basestring):
+            # Compressed files are read from the start, even when appending
+            bytesIn = os.path.getsize(inputfile)
+            if start != None and not compressed:
+                bytesIn -= start
+        started = time()
+        aggregated = self.__profileTime("aggregate")
 
-            x = float(row[xField])
-            y = float(row[yField])
-            
-            try:
-                parseDate = strptime(row[dateField],datefmt)
-            except ValueError as err:
-                raise DateError(err.args)
-            
-            myDate = date(*parseDate[0:3])
+        columns = fieldMap
+        if _hasNamedFields(fieldMap) and isinstance(inputfile,basestring):
+            columns = _resolveFieldMap(fieldMap,_readHeader(inputfile,quoteChar,delimChar))
 
-            id = None
-            if len(row) > 3:
-                id = row[3]
+        # Compressed files can't be split into chunks, so are read serially
+        if workers > 1 and isinstance(inputfile,basestring) and not compressed:
+            if progressUpdateFunc != None:
+                progressUpdateFunc("Reading data....")
+            progress = _ReadProgress(progressUpdateFunc,self.statusFunction,None,start or 0,os.path.getsize(inputfile))
+            self.offset = self.__readChunks(inputfile,(columns,) + inputOptions[1:],workers,progress,start,wholeLines)
+            self.__profiled("read",started)
+            self.__aggregate()
 
-            # Set date to beginning of aggregation period
-            if self.aggrUnit == 'D':
-                numDays = (myDate - self.minDate).days
-                numAggUnits = numDays // self.aggrCount
-                myDate = self.minDate + timedelta(days=self.aggrCount * numAggUnits)
-                
-            elif self.aggrUnit == 'M':
-                diffMonths = (myDate.year - self.minDate.year)*12 + myDate.month - self.minDate.month
-                numAggUnits = diffMonths // self.aggrCount
-                myDate = _addMonths(self.minDate,numAggUnits*self.aggrCount)
-                
-            elif self.aggrUnit == 'Y':
-                diffYears = myDate.year - self.minDate.year
-                numAggUnits = diffYears // self.aggrCount
-                year = self.minDate.year + numAggUnits * self.aggrCount
-                myDate = myDate.replace(year=year,month=1,day=1)
-                
+        else:
+            # Open CSV file, unless we've been handed something to iterate over
+            if isinstance(inputfile,basestring):
+                csvFile = _openInput(inputfile)
+                if start != None:
+                    csvFile.seek(start)
             else:
-                raise ValueError("Invalid aggregation unit!")
+                csvFile = inputfile
 
-            lockey = row[xField]+row[yField]
-                
-            if lockey in self.meshblocks:
-                self.meshblocks[lockey].addCase(myDate)
+            lines = csvFile
+            if wholeLines:
+                lines = _WholeLines(csvFile)
+            reader = _csvReader(lines,quoteChar,delimChar)
+            if csvFile is inputfile or start == None:
+                header = reader.next() # Skip header
+                columns = _resolveFieldMap(fieldMap,header)
+
+            # Wide, unquoted files are split straight out of memory instead
+            mapped = None
+            numFields = _numFields(columns,binner)
+            if csvFile is not inputfile and quoteChar == "" and not compressed:
+                mapped = _mapFile(csvFile,delimChar,numFields)
+            if mapped != None:
+                if start == None:
+                    start = mapped.find("\n") + 1
+                end = len(mapped)
+                if wholeLines:
+                    end = max(mapped.rfind("\n") + 1,start)
+                reader = _MappedReader(mapped,start,end,delimChar,numFields)
+            if progressUpdateFunc != None:
+                progressUpdateFunc("Reading data....")
+
+            progress = _ReadProgress(progressUpdateFunc,self.statusFunction)
+            if csvFile is not inputfile:
+                position = _inputPosition(inputfile,csvFile,reader)
+                if position != None:
+                    progress = _ReadProgress(progressUpdateFunc,self.statusFunction,
+                                             position,start or 0,os.path.getsize(inputfile))
+
+            try:
+                parseDate = _DateParser(datefmt)
+                rows = _tallyRows(reader,self.meshblocks,columns,parseDate,progress,binner)
+                self.__profiled("read",started,parseDate.parseTime + self.__profileTime("aggregate") - aggregated)
+                if self.profile != None:
+                    self.profile.add("dates",parseDate.parseTime)
+                    self.profile.count("dates parsed",parseDate.parsed)
+                self.__aggregate()
+                progress.finish(rows)
+
+                if mapped != None:
+                    self.offset = reader.end
+                elif csvFile is not inputfile:
+                    self.offset = csvFile.tell()
+                    if wholeLines:
+                        self.offset -= lines.partial
+            finally:
+                if mapped != None:
+                    mapped.close()
+                if csvFile is not inputfile:
+                    csvFile.close()
+
+        if isinstance(inputfile,basestring):
+            self.inputName = os.path.abspath(inputfile)
+            self.inputCheck = _inputCheck(inputfile,self.offset)
+        self.__findMaxNum()
+        if self.profile != None:
+            self.profile.count("rows",progress.status.rows)
+            self.profile.count("locations",len(self.meshblocks),True)
+            if bytesIn != None:
+                self.profile.count("bytes in",bytesIn)
+
+
+    def readColumns(self,source,fieldMap,datefmt="%Y-%m-%d",progressUpdateFunc=None,gridSize=None,geohash=None):
+        """Reads cases from columnar data rather than a CSV file, without
+        converting the columns to text (requires numpy).
+        source: a directory name, read as NpyColumns, or any other
+                object with a names list and a column(name) method.
+        fieldMap: as for readCSV, with column names or indices of
+                  source.names.  An 'id' entry gives the id column.
+        datefmt: the format of the date column, unless it holds numpy
+                 datetime64s.
+        gridSize, geohash: as for readCSV.
+
+    Locations are keyed on their (x,y) coordinates."""
+        if numpy == None:
+            raise ImportError("Reading columns requires numpy to be installed")
+        if isinstance(source,basestring):
+            source = NpyColumns(source)
+        binner = _makeBinner(gridSize,geohash)
+        names = list(source.names)
+        fields = _resolveFieldMap(fieldMap,names)
+
+        self.meshblocks = {}
+        self.offset = 0
+        self.inputOptions = None
+        self.inputName = None
+        self.inputCheck = None
+        self.maxDate = date.min
+        self.minDate = date.max
+
+        if progressUpdateFunc != None:
+            progressUpdateFunc("Reading data....")
+        progress = _ReadProgress(None,self.statusFunction)
+        started = time()
+        aggregated = self.__profileTime("aggregate")
+
+        x = numpy.asarray(source.column(names[fields['x']]),dtype=numpy.float64)
+        y = numpy.asarray(source.column(names[fields['y']]),dtype=numpy.float64)
+        ordinals = _dateOrdinals(source.column(names[fields['date']]),datefmt)
+        ids = None
+        if 'id' in fields:
+            ids = source.column(names[fields['id']])
+        if not len(x) == len(y) == len(ordinals):
+            raise ValueError("Columns are of different lengths")
+
+        # Number the locations
+        if binner == None:
+            keys,first,locations = numpy.unique(x + 1j * y,return_index=True,return_inverse=True)
+            lockeys = [(key.real,key.imag) for key in keys.tolist()]
+        else:
+            keys,first,locations = numpy.unique(binner.cells(x,y),return_index=True,return_inverse=True)
+            lockeys = keys.tolist()
+
+        locList = []
+        for lockey,index in izip(lockeys,first.tolist()):
+            if binner != None:
+                centreX,centreY = binner.centre(lockey)
+                meshblock = _Meshblock(centreX,centreY,binner.label(lockey))
             else:
-                self.meshblocks[lockey] = _Meshblock(x,y,id)
-                self.meshblocks[lockey].addCase(myDate)
+                id = None
+                if 'id' in fields:
+                    id = ids[index]
+                    if not isinstance(id,basestring):
+                        id = str(id)
+                meshblock = _Meshblock(lockey[0],lockey[1],id)
+            self.meshblocks[lockey] = meshblock
+            locList.append(meshblock)
+
+        self.__countArrays(locList,locations.astype(numpy.int32),ordinals.astype(numpy.int32))
+        self.__profiled("read",started,self.__profileTime("aggregate") - aggregated)
+        self.__findMaxNum()
+        progress.finish(len(ordinals))
+        if self.profile != None:
+            self.profile.count("rows",len(ordinals))
+            self.profile.count("locations",len(self.meshblocks),True)
 
+
+    def __findMaxNum(self):
         # Get max cases number
         self.maxNum = 0
         for key,meshblock in self.meshblocks.iteritems():
@@ -249,50 +1633,551 @@ class Cases2kml:
                 self.maxNum = myMaxCases
 
 
-    def serialize(self,docName,progressFunction=None):
-        # Now serialise the meshblocks into kml        
+    def saveState(self,filename):
+        """Saves the tallies of cases by location and day to filename,
+        along with the CSV settings used, the offset the last CSV file
+        name was read to, and that file's path and a check of its
+        contents up to the offset.  The file is replaced atomically, via a
+        temporary file of its own so that several processes can save
+        to the same name at once."""
+        started = time()
+        lockeys,coords,ids,locs,ordinals,counts = _packTallies(self.meshblocks)
+        header = {'version': _STATE_VERSION,
+                  'inputOptions': self.inputOptions,
+                  'offset': self.offset,
+                  'inputName': self.inputName,
+                  'inputCheck': self.inputCheck,
+                  'lockeys': lockeys,
+                  'ids': ids,
+                  'cells': len(counts) // array('i').itemsize}
+
+        fd,tmpName = tempfile.mkstemp(".tmp",os.path.basename(filename) + ".",os.path.dirname(filename) or ".")
+        try:
+            rawFile = os.fdopen(fd,"wb")
+            stateFile = gzip.GzipFile(filename,"wb",fileobj=rawFile)
+            stateFile.write(json.dumps(header,encoding="latin-1") + "\n")
+            for packed,typecode in ((coords,'d'),(locs,'i'),(ordinals,'i'),(counts,'i')):
+                stateFile.write(_littleEndian(packed,typecode))
+            stateFile.close()
+            rawFile.close()
+            os.chmod(tmpName,0644)
+            _replaceFile(tmpName,filename)
+        except:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+        self.__profiled("save state",started)
+
+
+    def loadState(self,filename):
+        """Restores tallies saved by saveState, ready to serialize or
+        to add new rows to with readCSV(...,append=True).  Periods are
+        rebucketed from the daily tallies, so a change of aggregation
+        settings is picked up."""
+        started = time()
+        stateFile = gzip.open(filename,"rb")
+        try:
+            try:
+                header = json.loads(stateFile.readline())
+            except ValueError:
+                header = None
+            if not isinstance(header,dict) or header.get('version') != _STATE_VERSION:
+                raise ValueError("'%s' is not a state file saved by this version of cases2kml" % filename)
+            header = _fromJSON(header)
+
+            arrays = []
+            for typecode,length in (('d',2 * len(header['lockeys'])),('i',header['cells']),
+                                    ('i',header['cells']),('i',header['cells'])):
+                size = length * array(typecode).itemsize
+                packed = stateFile.read(size)
+                if len(packed) != size:
+                    raise ValueError("'%s' is truncated" % filename)
+                arrays.append(_littleEndian(packed,typecode))
+        finally:
+            stateFile.close()
+        coords,locs,ordinals,counts = arrays
+        tallies = (header['lockeys'],coords,header['ids'],locs,ordinals,counts)
+
+        self.inputOptions = header['inputOptions']
+        self.offset = header['offset']
+        self.inputName = header['inputName']
+        self.inputCheck = header['inputCheck']
+        self.meshblocks = {}
+        _mergeTallies(self.meshblocks,tallies,{})
+        self.__profiled("load state",started)
+
+        self.__aggregate()
+        self.__findMaxNum()
+        if self.profile != None:
+            self.profile.count("locations",len(self.meshblocks),True)
+
+
+    def aggregate(self,aggrUnit,aggrCount):
+        """Re-buckets the tallies of cases by day into a different
+        aggregation, so several can be written from one read"""
+        if aggrUnit not in ('D','M','Y'):
+            raise ValueError("Invalid aggregation unit!")
+        if aggrCount < 1:
+            raise ValueError("Invalid aggregation count!")
+        self.aggrUnit = aggrUnit
+        self.aggrCount = aggrCount
+        self.__aggregate()
+        self.__findMaxNum()
+
+
+    def __wrote(self,folders,placemarks,finished=False):
+        """Counts folders and placemarks written, reporting the Status
+        of the write to the statusFunction"""
+        status = self.__writing
+        status.folders += folders
+        status.placemarks += placemarks
+        status.elapsed = time() - status.started
+        status.finished = finished
+        if self.statusFunction != None:
+            self.statusFunction(status)
+
+
+    def __writeParallel(self,outFile,renderer,workers,progressFunction,batchSize=1000):
+        """Renders batches of folders in a pool of worker processes,
+        writing them out in the order they were handed out.  Only a few
+        batches per worker are in flight at once, to bound memory."""
         numMeshBlocks = len(self.meshblocks)
-        serialized = StringIO()
-        
-        # Write kml header
-        serialized.write("""<?xml version="1.0" encoding="us-ascii"?>
-<kml xmlns="http://earth.google.com/kml/2.1">
-<Document>\n <name>""" + docName + "</name>\n")
+        meshblocks = self.meshblocks.itervalues()
+        pending = deque()
+        counter = 0
+
+        pool = Pool(workers,_initRenderer,(renderer,))
+        try:
+            while True:
+                batch = [(meshblock.x,meshblock.y,meshblock.id,meshblock.cases.items())
+                         for meshblock in islice(meshblocks,batchSize)]
+                if batch:
+                    placemarks = sum([len(cases) for x,y,id,cases in batch])
+                    pending.append((len(batch),placemarks,pool.apply_async(_renderFolders,(batch,))))
+                if not pending:
+                    break
+                if len(pending) >= 2 * workers or not batch:
+                    numFolders,placemarks,result = pending.popleft()
+                    outFile.write(result.get())
+                    self.__wrote(numFolders,placemarks)
+                    counter += numFolders
+                    if progressFunction != None:
+                        progressFunction(float(counter)/numMeshBlocks * 100)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+    def __caseCounts(self):
+        """Returns the set of numbers of cases in the placemarks"""
+        caseCounts = set()
+        for meshblock in self.meshblocks.itervalues():
+            caseCounts.update(meshblock.cases.itervalues())
+        return caseCounts
+
+
+    def __writeFolders(self,outFile,serialized,progressFunction,chunkSize,workers):
+        """Writes a folder per meshblock, for the current aggregation.
+        serialized holds output not yet written to outFile."""
+        numMeshBlocks = len(self.meshblocks)
+        renderer = _FolderRenderer(self.colour,self.pointMag,self.periods,self.scaleStep)
+
+        if workers > 1:
+            outFile.write(serialized.getvalue())
+            serialized.seek(0)
+            serialized.truncate()
+            self.__writeParallel(outFile,renderer,workers,progressFunction)
+            return
 
         counter = 0
+        placemarks = 0
         # Loop through meshblocks and serialize
         for key,meshblock in self.meshblocks.iteritems():
             
-            serialized.write( " <Folder>\n" )
-            serialized.write( "  <name>" + meshblock.id + "</name>\n" )
-
-            for date,numCases in meshblock.cases.iteritems():
+            serialized.write( renderer.folder(meshblock.x,meshblock.y,meshblock.id,meshblock.cases.iteritems()) )
+            placemarks += len(meshblock.cases)
 
-                serialized.write( self.__placemark(meshblock.x,meshblock.y,meshblock.id,date,numCases) + "\n" )
-
-            serialized.write( " </Folder>\n" )
+            if serialized.tell() >= chunkSize:
+                outFile.write(serialized.getvalue())
+                serialized.seek(0)
+                serialized.truncate()
             
             if progressFunction != None:
                 progressFunction(float(counter)/numMeshBlocks * 100)
                 
             counter += 1
+            if counter % 1000 == 0:
+                self.__wrote(1000,placemarks)
+                placemarks = 0
+
+        self.__wrote(counter % 1000,placemarks)
+
+
+    def write(self,outFile,docName,progressFunction=None,chunkSize=65536,workers=1,resolutions=None):
+        """Streams the KML document to the file object outFile, in
+        chunks of around chunkSize bytes.  If workers > 1, folders are
+        rendered in that many processes.
+
+        resolutions, a list of (aggrUnit,aggrCount) pairs, writes a
+        top level <Folder> for each aggregation in turn, leaving the
+        tallies aggregated as the last of them.
+
+        The statusFunction given to the constructor is called now and
+        then with a Status, and may raise ConversionCancelled to stop."""
+        started = time()
+        excluded = self.__profileTime("deflate") + self.__profileTime("aggregate")
+        self.__writing = Status("write",totalFolders=len(self.meshblocks) * len(resolutions or [None]))
+        serialized = StringIO()
+        
+        # Write kml header
+        serialized.write(_kmlHeader(docName))
+
+        if resolutions == None:
+            if self.scaleStep != None:
+                renderer = _FolderRenderer(self.colour,self.pointMag,self.periods,self.scaleStep)
+                serialized.write(renderer.styles(self.__caseCounts()))
+            self.__writeFolders(outFile,serialized,progressFunction,chunkSize,workers)
+
+        else:
+            if self.scaleStep != None:
+                # Styles are shared between all the resolutions
+                caseCounts = set()
+                for aggrUnit,aggrCount in resolutions:
+                    self.aggregate(aggrUnit,aggrCount)
+                    caseCounts.update(self.__caseCounts())
+                renderer = _FolderRenderer(self.colour,self.pointMag,self.periods,self.scaleStep)
+                serialized.write(renderer.styles(caseCounts))
+
+            for aggrUnit,aggrCount in resolutions:
+                self.aggregate(aggrUnit,aggrCount)
+                serialized.write( " <Folder>\n  <name>" + _resolutionName(aggrUnit,aggrCount) + "</name>\n" )
+                self.__writeFolders(outFile,serialized,progressFunction,chunkSize,workers)
+                serialized.write( " </Folder>\n" )
 
         # Write footer
         serialized.write( "</Document>\n" )
         serialized.write( "</kml>" )
-        
+        outFile.write(serialized.getvalue())
+        self.__wrote(0,0,True)
+        self.__profiledWrite(started,excluded)
+
+
+    def __profiledWrite(self,started,excluded):
+        """Adds the time since started, less the time spent deflating
+        and aggregating, to the "render" phase of the profile, if any,
+        along with the placemarks written"""
+        if self.profile != None:
+            excluded = self.__profileTime("deflate") + self.__profileTime("aggregate") - excluded
+            self.__profiled("render",started,excluded)
+            self.profile.count("placemarks",self.__writing.placemarks)
+
+
+    def writeKMZ(self,kmz,docName,progressFunction=None,workers=1,resolutions=None,compressLevel=zlib.Z_DEFAULT_COMPRESSION):
+        """Streams the KML document into the doc.kml member of kmz, a
+        ZipFile open for writing.  compressLevel is the zlib level the
+        document is deflated with, unless kmz is ZIP_STORED."""
+        docFile = _ZipEntryWriter(kmz,"doc.kml",kmz.compression,compressLevel,self.profile)
+        self.write(docFile,docName,progressFunction,workers=workers,resolutions=resolutions)
+        docFile.close()
+
+
+    def writeTiledKMZ(self,kmz,docName,progressFunction=None,maxFolders=1000,minLodPixels=128,compressLevel=zlib.Z_DEFAULT_COMPRESSION):
+        """Writes the placemarks into kmz as a quadtree of tiles, each
+        holding at most maxFolders locations in its own KML file under
+        tiles/.  Tiles are linked by <NetworkLink>s with <Region>s, so
+        a viewer only loads a tile once it covers minLodPixels on
+        screen, rather than loading every placemark up front."""
+        started = time()
+        excluded = self.__profileTime("deflate") + self.__profileTime("aggregate")
+        renderer = _FolderRenderer(self.colour,self.pointMag,self.periods,self.scaleStep)
+        numMeshBlocks = len(self.meshblocks)
+        points = [(meshblock.x,meshblock.y,lockey) for lockey,meshblock in self.meshblocks.iteritems()]
+
+        # Pad the extent so that a single location still has an area
+        west = min([x for x,y,lockey in points] or [0.0]) - 1e-4
+        east = max([x for x,y,lockey in points] or [0.0]) + 1e-4
+        south = min([y for x,y,lockey in points] or [0.0]) - 1e-4
+        north = max([y for x,y,lockey in points] or [0.0]) + 1e-4
+        root = _quadtree(points,(west,south,east,north),maxFolders)
+        del points
+        self.__writing = Status("write",totalFolders=numMeshBlocks)
+
+        docFile = _ZipEntryWriter(kmz,"doc.kml",kmz.compression,compressLevel,self.profile)
+        docFile.write(_kmlHeader(docName))
+        docFile.write(_TILE_LINK % (root.name,"","tiles/" + root.name + ".kml"))
+        docFile.write(_KML_FOOTER)
+        docFile.close()
+
+        counter = 0
+        tiles = [root]
+        while tiles:
+            tile = tiles.pop()
+            tileFile = _ZipEntryWriter(kmz,"tiles/" + tile.name + ".kml",kmz.compression,compressLevel,self.profile)
+            serialized = StringIO()
+            serialized.write(_kmlHeader(tile.name))
+            # KML wants a Document's styles, then its Region, then its features
+            if self.scaleStep != None and tile.lockeys:
+                caseCounts = set()
+                for lockey in tile.lockeys:
+                    caseCounts.update(self.meshblocks[lockey].cases.itervalues())
+                serialized.write(renderer.styles(caseCounts))
+            serialized.write(tile.region(minLodPixels))
+            for child in tile.children:
+                serialized.write(child.link(minLodPixels))
+            tileFile.write(serialized.getvalue())
+
+            placemarks = 0
+            for lockey in tile.lockeys:
+                meshblock = self.meshblocks[lockey]
+                tileFile.write(renderer.folder(meshblock.x,meshblock.y,meshblock.id,meshblock.cases.iteritems()))
+                placemarks += len(meshblock.cases)
+                counter += 1
+
+            tileFile.write(_KML_FOOTER)
+            tileFile.close()
+            tiles.extend(reversed(tile.children))
+            # Tiles that only link to their children have nothing to report
+            if tile.lockeys or not tiles:
+                self.__wrote(len(tile.lockeys),placemarks,len(tiles) == 0)
+
+            if progressFunction != None and numMeshBlocks > 0:
+                progressFunction(float(counter)/numMeshBlocks * 100)
+        self.__profiledWrite(started,excluded)
+
+
+    def writeTimeSlicedKMZ(self,kmz,docName,progressFunction=None,compressLevel=zlib.Z_DEFAULT_COMPRESSION):
+        """Writes the placemarks into kmz with a KML file per aggregation
+        period under periods/, each linked from doc.kml by a
+        <NetworkLink> carrying the period's <TimeSpan>.  A viewer then
+        only needs to parse the periods it is showing, rather than the
+        whole document, before it can play back through time.  The
+        placemarks aren't wrapped in location <Folder>s, as each file
+        only holds one placemark per location."""
+        started = time()
+        excluded = self.__profileTime("deflate") + self.__profileTime("aggregate")
+        renderer = _FolderRenderer(self.colour,self.pointMag,self.periods,self.scaleStep)
+        starts = self.periods.starts
+        ends = self.periods.ends
+
+        # Group the meshblocks by period
+        slices = {}
+        for meshblock in self.meshblocks.itervalues():
+            for period,numCases in meshblock.cases.iteritems():
+                try:
+                    slices[period].append((meshblock,numCases))
+                except KeyError:
+                    slices[period] = [(meshblock,numCases)]
+        periods = sorted(slices)
+        self.__writing = Status("write",totalPlacemarks=sum([len(placemarks) for placemarks in slices.itervalues()]))
+
+        docFile = _ZipEntryWriter(kmz,"doc.kml",kmz.compression,compressLevel,self.profile)
+        docFile.write(_kmlHeader(docName))
+        for period in periods:
+            docFile.write(_PERIOD_LINK % (starts[period],starts[period],ends[period],
+                                          "periods/" + starts[period] + ".kml"))
+        docFile.write(_KML_FOOTER)
+        docFile.close()
+
+        for counter,period in enumerate(periods):
+            placemarks = slices.pop(period)
+            periodFile = _ZipEntryWriter(kmz,"periods/" + starts[period] + ".kml",kmz.compression,compressLevel,self.profile)
+            periodFile.write(_kmlHeader(starts[period]))
+            if self.scaleStep != None:
+                periodFile.write(renderer.styles(set([numCases for meshblock,numCases in placemarks])))
+            for batch in xrange(0,len(placemarks),1000):
+                periodFile.write("".join([renderer.placemark(meshblock.x,meshblock.y,meshblock.id,period,numCases)
+                                          for meshblock,numCases in placemarks[batch:batch + 1000]]))
+            periodFile.write(_KML_FOOTER)
+            periodFile.close()
+            self.__wrote(0,len(placemarks),counter + 1 == len(periods))
+
+            if progressFunction != None:
+                progressFunction(float(counter + 1)/len(periods) * 100)
+        self.__profiledWrite(started,excluded)
+
+
+    def serialize(self,docName,progressFunction=None):
+        """Returns the KML document as a string"""
+        serialized = StringIO()
+        self.write(serialized,docName,progressFunction)
         return serialized.getvalue()
 
 
-def cases2kml(inputfile,outputfile,aggr='M',mag=1.0,colour='FF0000FF',dateformat='%Y-%m-%d'):
+_UNIT_NAMES = {'D': "day", 'M': "month", 'Y': "year"}
+
+# KMZ compression settings, as zip compression type and zlib level
+COMPRESSION = {'store': (ZIP_STORED,0),
+               'fast': (ZIP_DEFLATED,1),
+               'default': (ZIP_DEFLATED,zlib.Z_DEFAULT_COMPRESSION),
+               'max': (ZIP_DEFLATED,9)}
+
+
+def _resolutionName(aggrUnit,aggrCount):
+    """Describes an aggregation, eg. 1 month or 7 days"""
+    name = "%i %s" % (aggrCount,_UNIT_NAMES[aggrUnit])
+    if aggrCount != 1:
+        name += "s"
+    return name
+
+
+def _parseResolutions(aggr):
+    """Parses a comma separated list of aggregations such as "D,3M,Y"
+    into a list of (aggrUnit,aggrCount) pairs"""
+    resolutions = []
+    for item in aggr.split(","):
+        match = re.match(r"^\s*(\d*)([DMY])\s*$",item)
+        if match == None or int(match.group(1) or 1) < 1:
+            raise ValueError("Unrecognised aggregation level: '" + item + "'")
+        resolutions.append((match.group(2),int(match.group(1) or 1)))
+    return resolutions
+
+
+def _resolutionFileName(outputfile,aggrUnit,aggrCount):
+    """Inserts an aggregation, eg. "_3M", before outputfile's extension"""
+    root,ext = os.path.splitext(outputfile)
+    if aggrCount != 1:
+        return "%s_%i%s%s" % (root,aggrCount,aggrUnit,ext)
+    return "%s_%s%s" % (root,aggrUnit,ext)
+
+
+class _TallyCache:
+    """A directory of saved tallies (see Cases2kml.saveState) keyed on
+    the SHA-1 of an input file plus the CSV settings used to read it.
+
+    As the tallies are by day, the aggregation and display settings can
+    change without missing the cache.  Once the cache exceeds maxSize
+    bytes, the least recently used entries are removed."""
+
+    def __init__(self,directory=None,maxSize=1024**3):
+        if directory == None:
+            directory = os.environ.get("CASES2KML_CACHE",os.path.expanduser(os.path.join("~",".cases2kml","cache")))
+        self.directory = directory
+        self.maxSize = maxSize
+
+    def key(self,filename,inputOptions):
+        digest = hashlib.sha1(repr(inputOptions))
+        inputFile = open(filename,"rb")
+        block = inputFile.read(1024*1024)
+        while block:
+            digest.update(block)
+            block = inputFile.read(1024*1024)
+        inputFile.close()
+        return digest.hexdigest()
+
+    def __path(self,key):
+        return os.path.join(self.directory,key + ".gz")
+
+    def __entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory,name) for name in os.listdir(self.directory) if name.endswith(".gz")]
+
+    def load(self,converter,key):
+        """Loads cached tallies into converter, returning False if there
+        are none.  An entry that can't be loaded, eg. one evicted by
+        another process since we looked, or from an older version, is
+        removed and treated as missing."""
+        path = self.__path(key)
+        if not os.path.exists(path):
+            return False
+        try:
+            converter.loadState(path)
+            os.utime(path,None) # Mark as recently used
+        except Exception:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def store(self,converter,key):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another process, eg. in a batch, may have beaten us to it
+                if not os.path.isdir(self.directory):
+                    raise
+        converter.saveState(self.__path(key))
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until within maxSize.
+        Entries removed meanwhile by another process are skipped."""
+        entries = []
+        for path in self.__entries():
+            try:
+                entries.append((os.path.getmtime(path),os.path.getsize(path),path))
+            except OSError:
+                pass
+        entries.sort()
+        totalSize = sum([size for mtime,size,path in entries])
+        while entries and totalSize > self.maxSize:
+            mtime,size,path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            totalSize -= size
+
+    def clear(self):
+        for path in self.__entries():
+            os.remove(path)
+
+
+def cases2kml(inputfile,outputfile,aggr='M',mag=1.0,colour='FF0000FF',dateformat='%Y-%m-%d',scaleStep=None,workers=1,stateFile=None,cache=False,combine=False,gridSize=None,geohash=None,tiles=None,timeSlices=False,compression='default',progress=False,profile=None):
     """cases2kml takes a CSV file of cases, and outputs a file in KMZ format for viewing in Google Earth.
 
 Arguments:
-  inputfile - the input CSV file
-  outputfile - the name of the .kmz file to write to
-  aggr - the aggregation level, currently supported values are D, M, Y
+  inputfile - the input CSV file, which may be compressed with gzip,
+              bzip2 or xz and named accordingly, or a directory of x.npy, y.npy,
+              date.npy and optionally id.npy columns (see NpyColumns)
+  outputfile - the name of the .kmz file to write to, or of a .kml file
+               to write the document uncompressed
+  aggr - the aggregation level, currently supported values are D, M, Y.
+         A count may be given, eg. 3M, and several levels may be given
+         separated by commas, eg. D,M,Y, in which case the input is
+         read once and a file written for each level, named by adding
+         eg. _M to outputfile
   mag - the magnification level for the map points in Google Earth
   dateformat - the strftime formatting code for time
+  scaleStep - if given, point sizes are rounded to multiples of scaleStep
+              and share styles, making for a smaller, faster loading file
+  workers - the number of processes used to read the input and write
+            the output
+  stateFile - if given, the tallies are saved here.  If it already
+              exists, only rows added to inputfile since it was saved
+              are read.  A last line with no newline is left for the
+              next run, as it may still be being written.
+  cache - if True, tallies read from inputfile are cached (see
+          _TallyCache) so that converting it again with other
+          aggregation or display settings skips reading it.  Looking
+          it up means hashing the whole input, an extra read of it.
+  combine - write several aggregation levels into a single file, each
+            in its own folder
+  gridSize - if given, cases are binned into squares of this many
+             degrees, with a placemark at the centre of each
+  geohash - as gridSize, but binning into geohash cells of this many
+            characters
+  tiles - if given, the placemarks are split into tiles of at most this
+          many locations, which Google Earth loads as they come into
+          view (see Cases2kml.writeTiledKMZ)
+  timeSlices - if True, the placemarks for each aggregation period are
+               written to their own file, so that Google Earth only
+               loads the periods it is showing (see
+               Cases2kml.writeTimeSlicedKMZ)
+  compression - how hard to compress the .kmz file: 'store', 'fast',
+                'default' or 'max'.  Storing or fast deflate write a
+                larger file in less time.
+  progress - if True, a line of progress, throughput and estimated
+             time left is printed to stderr every second or so
+  profile - if given, a Profile to add the time spent in each phase of
+            the conversion, and counts of rows, placemarks and bytes
+            in and out, to
 
 Details:
   The format of the CSV file must conform to the fields:
@@ -308,31 +2193,262 @@ Details:
 
     sys.stdout.flush()
 
-    kmlWriter = Cases2kml(aggr,mag,1,colour)
+    resolutions = _parseResolutions(aggr)
+    if tiles != None and combine and len(resolutions) > 1:
+        raise ValueError("Tiled output can't combine aggregation levels")
+    if timeSlices and combine and len(resolutions) > 1:
+        raise ValueError("Time sliced output can't combine aggregation levels")
+    if timeSlices and tiles != None:
+        raise ValueError("Output can't be both tiled and time sliced")
+    if compression not in COMPRESSION:
+        raise ValueError("Invalid compression '%s'" % compression)
+    plainKML = os.path.splitext(outputfile)[1].lower() == ".kml"
+    if plainKML and (tiles != None or timeSlices):
+        raise ValueError("Tiled and time sliced output must be written to a .kmz file")
+    aggrUnit,aggrCount = resolutions[0]
+    statusFunction = None
+    if progress:
+        statusFunction = _StatusPrinter()
+    kmlWriter = Cases2kml(aggrUnit,aggrCount,mag,colour,scaleStep,statusFunction,profile)
     
     fieldMap = {'x': 0, 'y': 1, 'date': 2}
 
-    kmlWriter.readCSV(inputfile,fieldMap,dateformat)
+    if os.path.isdir(inputfile):
+        if stateFile != None:
+            raise ValueError("A state file can only be kept for CSV input")
+        columns = NpyColumns(inputfile)
+        fieldMap = {'x': 'x', 'y': 'y', 'date': 'date'}
+        if 'id' in columns.names:
+            fieldMap['id'] = 'id'
+        kmlWriter.readColumns(columns,fieldMap,dateformat,gridSize=gridSize,geohash=geohash)
+
+    append = False
+    if stateFile != None and os.path.exists(stateFile):
+        print "Resuming from '" + stateFile + "'"
+        kmlWriter.loadState(stateFile)
+        append = True
+
+    tallyCache = None
+    if cache and stateFile == None and not os.path.isdir(inputfile):
+        tallyCache = _TallyCache()
+        started = time()
+        cacheKey = tallyCache.key(inputfile,(fieldMap,dateformat,"",",",gridSize,geohash))
+        if profile != None:
+            profile.add("cache key",time() - started)
+
+    if tallyCache != None and tallyCache.load(kmlWriter,cacheKey):
+        print "Using cached tallies"
+    elif not os.path.isdir(inputfile):
+        kmlWriter.readCSV(inputfile,fieldMap,dateformat,workers=workers,append=append,
+                          gridSize=gridSize,geohash=geohash,wholeLines=stateFile != None)
+        if tallyCache != None:
+            # The cache only saves time, so failing to update it isn't fatal
+            try:
+                tallyCache.store(kmlWriter,cacheKey)
+            except Exception as err:
+                print "Couldn't cache the tallies: %s" % err
+
+    if stateFile != None:
+        kmlWriter.saveState(stateFile)
+
+    # Serialize to kmz file(s)
+    if len(resolutions) > 1 and not combine:
+        outputs = [(_resolutionFileName(outputfile,aggrUnit,aggrCount),[(aggrUnit,aggrCount)])
+                   for aggrUnit,aggrCount in resolutions]
+    else:
+        outputs = [(outputfile,resolutions)]
 
-    # Serialize to kmz file
-    kmz = ZipFile(outputfile,"w",ZIP_DEFLATED)
-    kmz.writestr("doc.kml",kmlWriter.serialize(outputfile))
-    kmz.close()
+    compressType,compressLevel = COMPRESSION[compression]
+    for fileName,fileResolutions in outputs:
+        if len(outputs) > 1:
+            print "Writing '" + fileName + "'"
+        if len(fileResolutions) == 1:
+            if fileResolutions[0] != (kmlWriter.aggrUnit,kmlWriter.aggrCount):
+                kmlWriter.aggregate(*fileResolutions[0])
+            fileResolutions = None
+
+        if plainKML:
+            kmlFile = open(fileName,"wb")
+            kmlWriter.write(kmlFile,fileName,workers=workers,resolutions=fileResolutions)
+            kmlFile.close()
+            continue
+
+        kmz = ZipFile(fileName,"w",compressType,True)
+        if tiles != None:
+            kmlWriter.writeTiledKMZ(kmz,fileName,maxFolders=tiles,compressLevel=compressLevel)
+        elif timeSlices:
+            kmlWriter.writeTimeSlicedKMZ(kmz,fileName,compressLevel=compressLevel)
+        else:
+            kmlWriter.writeKMZ(kmz,fileName,workers=workers,resolutions=fileResolutions,compressLevel=compressLevel)
+        kmz.close()
+
+    if profile != None:
+        for fileName,fileResolutions in outputs:
+            profile.count("bytes out",os.path.getsize(fileName))
 
     print "Done\n"
 
 
+# Endings of the CSV files picked up from a batch directory
+_BATCH_EXTENSIONS = ('.csv','.csv.gz','.csv.bz2','.csv.xz')
+
+
+def _batchInputs(source):
+    """Returns the sorted input files named by source: a directory, whose
+    CSV files (compressed or not) are converted, a glob pattern, or a
+    manifest file listing an input per line.  Manifest paths are
+    relative to the manifest, and blank lines and #comments are
+    ignored."""
+    if os.path.isdir(source):
+        return sorted([os.path.join(source,name) for name in os.listdir(source)
+                       if name.lower().endswith(_BATCH_EXTENSIONS)
+                       and os.path.isfile(os.path.join(source,name))])
+    if glob.has_magic(source):
+        return sorted(glob.glob(source))
+
+    manifest = open(source,"rb")
+    lines = [line.strip() for line in manifest]
+    manifest.close()
+    base = os.path.dirname(source)
+    return [os.path.join(base,line) for line in lines if line and not line.startswith("#")]
+
+
+def _batchOutput(inputfile,outputDirectory,extension):
+    """Names the output for inputfile in outputDirectory, by replacing
+    any .csv and compression extensions with extension"""
+    name = os.path.basename(inputfile)
+    for ending in sorted(_BATCH_EXTENSIONS + _COMPRESSED_EXTENSIONS,key=len,reverse=True):
+        if name.lower().endswith(ending):
+            name = name[:-len(ending)]
+            break
+    return os.path.join(outputDirectory,name + extension)
+
+
+def _convertBatchFile(args):
+    """Worker process function: converts one file of a batch, returning
+    (inputfile, outputfiles, seconds, counts, error), where counts are
+    those of a Profile and error is None or a description of the
+    exception that stopped the conversion"""
+    inputfile,outputfile,options = args
+    outputfiles = [outputfile]
+    resolutions = _parseResolutions(options.get('aggr','M'))
+    if len(resolutions) > 1 and not options.get('combine'):
+        outputfiles = [_resolutionFileName(outputfile,aggrUnit,aggrCount) for aggrUnit,aggrCount in resolutions]
+    profile = Profile()
+    error = None
+    started = time()
+
+    # cases2kml() reports on stdout, which would garble the summary
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull,"w")
+    try:
+        cases2kml(inputfile,outputfile,profile=profile,**options)
+    except Exception as err:
+        error = "%s: %s" % (type(err).__name__,err)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    if error != None:
+        for outputfile in outputfiles:
+            if os.path.exists(outputfile):
+                os.remove(outputfile)
+    return inputfile,outputfiles,time() - started,profile.counts,error
+
+
+def cases2kmlBatch(source,outputDirectory,workers=1,options=None,extension=".kmz",stream=None):
+    """Converts a batch of CSV files with the same settings, several at
+    a time, printing a line per file to stream (stdout by default) as
+    each finishes.
+
+Arguments:
+  source - a directory, whose .csv files (and .csv.gz, .csv.bz2 and
+           .csv.xz files) are converted, a glob pattern, or a manifest
+           file listing an input file per line
+  outputDirectory - where to write the outputs, named after the inputs
+                    with extension in place of .csv
+  workers - the number of files to convert at once, each in its own
+            process reading and writing with a single worker
+  options - a dict of keyword arguments to cases2kml() shared by every
+            file, eg. {'aggr': 'M', 'compression': 'fast'}
+  extension - .kmz, or .kml to write the documents uncompressed
+
+A file that fails to convert, eg. with a DateError, is reported and
+its output removed without stopping the rest of the batch.  Returns
+the list of (inputfile, outputfiles, seconds, counts, error) of each
+file, in input order (see _convertBatchFile)."""
+    stream = stream or sys.stdout
+    options = dict(options or {})
+    for name in ('workers','stateFile','progress','profile'):
+        if name in options:
+            raise ValueError("'%s' can't be set for the files of a batch" % name)
+
+    inputs = _batchInputs(source)
+    if not inputs:
+        raise ValueError("No input files found in '%s'" % source)
+    outputs = [_batchOutput(inputfile,outputDirectory,extension) for inputfile in inputs]
+    if len(set(outputs)) < len(outputs):
+        raise ValueError("Several inputs in '%s' would be written to the same output" % source)
+    if not os.path.isdir(outputDirectory):
+        os.makedirs(outputDirectory)
+
+    tasks = [(inputfile,outputfile,options) for inputfile,outputfile in izip(inputs,outputs)]
+    started = time()
+    results = []
+    pool = None
+    if workers > 1:
+        pool = Pool(workers)
+    try:
+        if pool != None:
+            converted = pool.imap_unordered(_convertBatchFile,tasks)
+        else:
+            converted = (_convertBatchFile(task) for task in tasks)
+
+        for result in converted:
+            inputfile,outputfiles,seconds,counts,error = result
+            if error == None:
+                # Cached tallies have no rows read
+                parts = ["%s placemarks" % format(counts.get("placemarks",0),","),"%.1fs" % seconds]
+                if "rows" in counts:
+                    parts.insert(0,"%s rows" % format(counts["rows"],","))
+                stream.write("OK      %s -> %s  %s\n" % (inputfile,", ".join(outputfiles),", ".join(parts)))
+            else:
+                stream.write("FAILED  %s  %s\n" % (inputfile,error))
+            stream.flush()
+            results.append(result)
+        if pool != None:
+            pool.close()
+    except:
+        if pool != None:
+            pool.terminate()
+        raise
+    finally:
+        if pool != None:
+            pool.join()
+
+    failed = len([result for result in results if result[4] != None])
+    stream.write("Converted %i of %i files in %.1fs" % (len(results) - failed,len(results),time() - started))
+    if failed:
+        stream.write(", %i failed" % failed)
+    stream.write("\n")
+
+    order = dict([(inputfile,i) for i,inputfile in enumerate(inputs)])
+    results.sort(key=lambda result: order[result[0]])
+    return results
+
+
 
 if __name__ == "__main__":
     
     # Command line options
 
-    usage = """usage: %prog [options] <input csv> <output kml>"""
+    usage = """usage: %prog [options] <input csv[.gz|.bz2|.xz]> <output kmz|kml>
+       %prog --batch [options] <input directory|glob|manifest> <output directory>"""
     optparse = OptionParser(usage=usage,version="%prog "+version)
     
     optparse.add_option("-a", "--aggregate", dest="aggregate",
                         action="store",default="M",
-                        help="set level of time aggregation [D,M,Y] [default: %default]")
+                        help="set level of time aggregation [D,M,Y], optionally with a count (eg. 3M), or a comma separated list of levels (eg. D,M,Y) [default: %default]")
     optparse.add_option("-d", "--date-format", dest="dateformat",
                         default="%Y-%m-%d",
                         help="Python time.strftime() format representing date [default: %default]")
@@ -342,19 +2458,114 @@ if __name__ == "__main__":
     optparse.add_option("-c","--colour", dest="col",
                         default='FF0000FF',
                         help="Map point colour expressed as AABBGGRR (ie KML spec)")
+    optparse.add_option("-s","--style-step", dest="styleStep",
+                        type="float", default=None,
+                        help="Share point styles, rounding the magnified point sizes to multiples of STYLESTEP")
+    optparse.add_option("-j","--jobs", dest="jobs",
+                        type="int", default=1,
+                        help="Number of processes to read the input and write the output with [default: %default]")
+    optparse.add_option("--state", dest="stateFile",
+                        default=None,
+                        help="Keep case tallies in STATEFILE, so that later runs only read rows appended to the input")
+    optparse.add_option("--cache", dest="cache",
+                        action="store_true", default=False,
+                        help="Cache the tallies read from the input, so that converting it again with other aggregation or display settings skips reading it.  Finding the cache entry means reading the whole input once to hash it, so this only pays off for inputs converted more than once")
+    optparse.add_option("--no-cache", dest="cache",
+                        action="store_false",
+                        help="Don't use or update the cache of previously read inputs [default]")
+    optparse.add_option("--clear-cache", dest="clearCache",
+                        action="store_true", default=False,
+                        help="Empty the cache of previously read inputs before converting")
+    optparse.add_option("--combine", dest="combine",
+                        action="store_true", default=False,
+                        help="With several aggregation levels, write them all to one file rather than one file each")
+    optparse.add_option("-g","--grid", dest="gridSize",
+                        type="float", default=None,
+                        help="Bin cases into squares of GRIDSIZE degrees, plotting one point per square")
+    optparse.add_option("--geohash", dest="geohash",
+                        type="int", default=None,
+                        help="Bin cases into geohash cells with GEOHASH characters, plotting one point per cell")
+    optparse.add_option("--tiles", dest="tiles",
+                        type="int", default=None,
+                        help="Split the output into tiles of at most TILES locations, loaded as they come into view")
+    optparse.add_option("-z","--compression", dest="compression",
+                        type="choice", choices=["store","fast","default","max"], default="default",
+                        help="KMZ compression: store, fast, default or max.  An output name ending .kml is written uncompressed [default: %default]")
+    optparse.add_option("--progress", dest="progress",
+                        action="store_true", default=False,
+                        help="Print progress, rows/s or placemarks/s and time left to stderr while converting")
+    optparse.add_option("--profile", dest="profile",
+                        action="store_true", default=False,
+                        help="Print the time spent in each phase of the conversion, with row, placemark, byte and peak memory counts, to stderr")
+    optparse.add_option("--cprofile", dest="cprofile",
+                        default=None,
+                        help="Run the conversion under cProfile, dumping the stats to CPROFILE for pstats or a viewer")
+    optparse.add_option("--batch", dest="batch",
+                        action="store_true", default=False,
+                        help="Convert every CSV file in a directory, matching a quoted glob or listed in a manifest file, into an output directory.  -j sets the number of files converted at once")
+    optparse.add_option("--time-slices", dest="timeSlices",
+                        action="store_true", default=False,
+                        help="Write each aggregation period to its own file, loaded as the time slider reaches it")
 
     (options,args) = optparse.parse_args()
 
+    if options.clearCache:
+        _TallyCache().clear()
+        if len(args) == 0:
+            sys.exit(0)
+
     # Check args
     if len(args) != 2:
         optparse.print_help()
         sys.exit(1)
 
     # Check options
-    if options.aggregate not in ['D','M','Y']:
-        print "Unrecognised aggregation level: '" + options.aggregate + "'"
+    try:
+        _parseResolutions(options.aggregate)
+        _makeBinner(options.gridSize,options.geohash)
+        if options.tiles != None and options.tiles < 1:
+            raise ValueError("Tile size must be at least 1")
+        if options.tiles != None and options.combine:
+            raise ValueError("--tiles can't be used with --combine")
+        if options.timeSlices and options.combine:
+            raise ValueError("--time-slices can't be used with --combine")
+        if options.timeSlices and options.tiles != None:
+            raise ValueError("--time-slices can't be used with --tiles")
+        if args[1].lower().endswith(".kml") and (options.tiles != None or options.timeSlices) and not options.batch:
+            raise ValueError("--tiles and --time-slices need a .kmz output file")
+        if options.batch and (options.stateFile != None or options.progress or options.profile or options.cprofile != None):
+            raise ValueError("--batch can't be used with --state, --progress, --profile or --cprofile")
+    except ValueError as err:
+        print err.args[0]
         sys.exit(1)
  
-    cases2kml(args[0],args[1],options.aggregate,options.mag,options.col,options.dateformat)
+    if options.batch:
+        try:
+            results = cases2kmlBatch(args[0],args[1],options.jobs,
+                                     {'aggr': options.aggregate, 'mag': options.mag, 'colour': options.col,
+                                      'dateformat': options.dateformat, 'scaleStep': options.styleStep,
+                                      'cache': options.cache, 'combine': options.combine,
+                                      'gridSize': options.gridSize, 'geohash': options.geohash,
+                                      'tiles': options.tiles, 'timeSlices': options.timeSlices,
+                                      'compression': options.compression})
+        except (ValueError,IOError) as err:
+            print err
+            sys.exit(1)
+        if [result for result in results if result[4] != None]:
+            sys.exit(1)
+        sys.exit(0)
+
+    profile = None
+    if options.profile:
+        profile = Profile()
+    conversion = (args[0],args[1],options.aggregate,options.mag,options.col,options.dateformat,options.styleStep,options.jobs,options.stateFile,options.cache,options.combine,options.gridSize,options.geohash,options.tiles,options.timeSlices,options.compression,options.progress,profile)
+    if options.cprofile != None:
+        import cProfile
+        cProfile.runctx("cases2kml(*conversion)",globals(),locals(),options.cprofile)
+    else:
+        cases2kml(*conversion)
+
+    if profile != None:
+        sys.stderr.write(str(profile) + "\n")
 
     sys.exit(0)
@@ -1,12 +1,15 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import os
 import wx
 import csv
+import threading
+from time import time
 from traceback import print_exc
 from string import join
-from zipfile import ZipFile,ZIP_DEFLATED
-from cases2kml import Cases2kml, DateError
+from zipfile import ZipFile
+from cases2kml import Cases2kml, DateError, ConversionCancelled, COMPRESSION
 from math import floor
 
 
@@ -221,6 +224,12 @@ class ChooseOutputOptions(wx.Panel):
         
         colLabel = wx.StaticText(self,label="Map point colour: ",name="colLabel")
         self.col = wx.ColourPickerCtrl(self,col=wx.RED)
+
+        # KMZ compression, as (label, cases2kml.COMPRESSION key)
+        self.compressions = [("Default","default"),("Fast","fast"),("Maximum","max"),("None","store")]
+        compressionLabel = wx.StaticText(self,label="KMZ compression: ",name="compressionLabel")
+        self.compression = wx.Choice(self,choices=[label for label,key in self.compressions],name="compression")
+        self.compression.SetSelection(0)
         
         # Layout        
         magSizer = wx.BoxSizer(wx.HORIZONTAL)
@@ -230,7 +239,12 @@ class ChooseOutputOptions(wx.Panel):
         magSizer.Add(colLabel,0,wx.LEFT, border=10)
         magSizer.Add(self.col,0)
 
+        compressionSizer = wx.BoxSizer(wx.HORIZONTAL)
+        compressionSizer.Add(compressionLabel)
+        compressionSizer.Add(self.compression)
+
         staticBoxSizer.Add(magSizer)
+        staticBoxSizer.Add(compressionSizer,0,wx.TOP,border=8)
         
         mainSizer = wx.BoxSizer(wx.VERTICAL)
         mainSizer.Add(staticBoxSizer,0,wx.EXPAND | wx.ALL, border=10)
@@ -286,6 +300,9 @@ class ChooseOutputOptions(wx.Panel):
         return "%02X%02X%02X%02X" % (alpha,blue,green,red)
         
     
+    def getCompression(self):
+        return self.compressions[self.compression.GetSelection()][1]
+
     def getOutputFileName(self):
         return str( self.optFilePicker.GetPath() )
     
@@ -316,6 +333,7 @@ class MainWindow(wx.Frame):
 
         # Housekeeping
         self.fieldMap = {'x': None, 'y': None, 'date': None}
+        self.progress = None
 
         wx.Frame.__init__(self,parent,title=title)
         
@@ -437,40 +455,115 @@ Purpose: Converts CSV files of disease cases into time-aggregated Google Earth .
 
     def generateKML(self,outputFileName):
         
-        progress = wx.ProgressDialog("Processing","Reading CSV. Please wait...",style=wx.PD_SMOOTH | wx.PD_REMAINING_TIME)
-        
+        # A .kml file is written as is, otherwise compressed into a .kmz
+        plainKML = outputFileName.lower().endswith(".kml")
+        compressType,compressLevel = COMPRESSION[self.chooseOutputOptionsPanel.getCompression()]
         try:
-            kmz = ZipFile( outputFileName,"w",ZIP_DEFLATED)
+            if plainKML:
+                kmz = open( outputFileName,"wb")
+            else:
+                kmz = ZipFile( outputFileName,"w",compressType,True)
         except IOError as err:
             ErrorDialog(self,"Could not open output file: " + err.args[1])
-            progress.Destroy()
             return
 
+        # Read the settings here, as the controls mustn't be touched from
+        # the conversion thread
+        converter = Cases2kml( self.chooseFieldPanel.getAggrUnit(),self.chooseFieldPanel.getAggrCount(), self.chooseOutputOptionsPanel.getMagnification(), self.chooseOutputOptionsPanel.getKMLColour(),
+                               statusFunction=self.reportStatus )
+        csvOptions = ( self.iptFilePanel.chooseFile.GetPath(),
+                       dict(self.fieldMap),
+                       self.chooseFieldPanel.dateFmt.GetValue(),
+                       self.iptFilePanel.GetQuoteChar(),
+                       self.iptFilePanel.GetDelimChar() )
+
+        self.progress = wx.ProgressDialog("Processing","Reading CSV. Please wait...",maximum=100,parent=self,
+                                          style=wx.PD_SMOOTH | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT | wx.PD_APP_MODAL)
+        self.lastProgress = 0.0
+        self.phaseMessages = {"read": "Reading CSV. Please wait...",
+                              "write": "Writing KMZ file.  Please wait..."}
+        if plainKML:
+            self.phaseMessages["write"] = "Writing KML file.  Please wait..."
+        self.cancelled = threading.Event()
+
+        worker = threading.Thread(target=self.convert,args=(converter,csvOptions,kmz,outputFileName,plainKML,compressLevel))
+        worker.daemon = True
+        worker.start()
+
+    def convert(self,converter,csvOptions,kmz,outputFileName,plainKML,compressLevel):
+        """Runs the conversion on a worker thread, posting progress and
+        the outcome back to the main thread"""
+        error = None
+        try:
+            try:
+                converter.readCSV( *csvOptions )
+                if plainKML:
+                    converter.write( kmz, outputFileName )
+                else:
+                    converter.writeKMZ( kmz, outputFileName, compressLevel=compressLevel )
+            finally:
+                kmz.close()
+        except Exception as err:
+            if not isinstance(err,ConversionCancelled):
+                print_exc()
+            error = err
+
+        # The dialog must hear the outcome, even if the partial output
+        # can't be removed, or it is left open
         try:
-            converter = Cases2kml( self.chooseFieldPanel.getAggrUnit(),self.chooseFieldPanel.getAggrCount(), self.chooseOutputOptionsPanel.getMagnification(), self.chooseOutputOptionsPanel.getKMLColour() )
-            converter.readCSV( self.iptFilePanel.chooseFile.GetPath(),
-                               self.fieldMap,
-                               self.chooseFieldPanel.dateFmt.GetValue(),
-                               self.iptFilePanel.GetQuoteChar(),
-                               self.iptFilePanel.GetDelimChar(),
-                               progress.Pulse )                 
-            progress.Pulse("Writing KMZ file.  Please wait...")
-            kmz.writestr("doc.kml",converter.serialize( outputFileName, progress.Update ))
+            if error != None:
+                os.remove(outputFileName)
+        except OSError:
+            print_exc()
+        finally:
+            wx.CallAfter(self.OnConversionDone,error)
+
+    def reportStatus(self,status):
+        """Status callback for the conversion thread.  Raises
+        ConversionCancelled once Cancel has been pressed, otherwise
+        passes the progress on to the dialog, at most ten times a
+        second"""
+        if self.cancelled.isSet():
+            raise ConversionCancelled()
+
+        now = time()
+        if status.finished or now - self.lastProgress >= 0.1:
+            self.lastProgress = now
+            message = self.phaseMessages[status.phase] + "\n" + str(status)
+            wx.CallAfter(self.OnProgress,status.percent(),message)
+
+    def OnProgress(self,percent,message):
+        if self.progress == None:
+            return
+
+        # The size of bzip2 and xz input can't be told, so just pulse
+        if percent != None:
+            keepGoing,skip = self.progress.Update(int(percent),message)
+        else:
+            keepGoing,skip = self.progress.Pulse(message)
+
+        if not keepGoing:
+            self.progress.Pulse("Cancelling...")
+            self.cancelled.set()
+
+    def OnConversionDone(self,error):
+        self.progress.Destroy()
+        self.progress = None
+
+        if error == None:
             InfoDialog(self,"Conversion complete")
-        
-        except DateError as err:
+
+        elif isinstance(error,ConversionCancelled):
+            InfoDialog(self,"Conversion cancelled")
+
+        elif isinstance(error,DateError):
             ErrorDialog(self,"Could not parse the date field.  Please check your date format settings.")
             
-        except IOError as err:
-            print_exc()
+        elif isinstance(error,IOError):
             ErrorDialog(self,"Cannot open CSV file.  Please check the file permissions.")
   
-        except Exception as e:
-            ErrorDialog(self,"An unknown error prevented the .kmz file from being written:\n\n \"" + str(e) + "\"\n\nPlease check your settings.")
-            print_exc()
-            
-        kmz.close()    
-        progress.Destroy()        
+        else:
+            ErrorDialog(self,"An unknown error prevented the .kmz file from being written:\n\n \"" + str(error) + "\"\n\nPlease check your settings.")
 
 
 
@@ -0,0 +1,8 @@
+"""
+Tests for cases2kml.
+
+Run from the top of the source tree with:
+
+   $ python -m unittest discover -s tests -t .
+
+"""
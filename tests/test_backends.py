@@ -0,0 +1,81 @@
+"""
+Checks that readColumns, which counts cases with numpy, tallies the same
+cases as readCSV.
+"""
+
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+
+import cases2kml
+from cases2kml import Cases2kml
+from benchmarks.synthetic import writeCases
+
+
+def caseTable(converter):
+    table = set()
+    for lockey,meshblock in converter.meshblocks.iteritems():
+        for period,numCases in meshblock.cases.iteritems():
+            table.add((lockey,meshblock.x,meshblock.y,meshblock.id,period,numCases))
+    return table
+
+
+def writeColumns(filename,directory):
+    """Writes the columns of a CSV file of cases as .npy files"""
+    csvFile = open(filename,"rb")
+    reader = csv.reader(csvFile)
+    names = reader.next()
+    columns = zip(*reader)
+    csvFile.close()
+    for name,column in zip(names,columns):
+        if name in ("x","y"):
+            column = [float(value) for value in column]
+        cases2kml.numpy.save(os.path.join(directory,name + ".npy"),cases2kml.numpy.array(column))
+
+
+@unittest.skipIf(cases2kml.numpy == None,"numpy is not installed")
+class BackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory,"cases.csv")
+        writeCases(self.filename,20000,500,numDays=800)
+        self.columns = os.path.join(self.directory,"columns")
+        os.mkdir(self.columns)
+        writeColumns(self.filename,self.columns)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def readBoth(self,aggrUnit,aggrCount,**options):
+        """Returns the case tables read by readCSV and readColumns.
+        Unbinned locations are keyed on coordinate strings by one and
+        on numbers by the other, so the keys are left out."""
+        fromCSV = Cases2kml(aggrUnit,aggrCount,1.0,'FF0000FF')
+        fromCSV.readCSV(self.filename,{'x': 0, 'y': 1, 'date': 2},**options)
+        fromColumns = Cases2kml(aggrUnit,aggrCount,1.0,'FF0000FF')
+        fromColumns.readColumns(self.columns,{'x': 'x', 'y': 'y', 'date': 'date', 'id': 'id'},**options)
+        self.assertEqual(fromCSV.maxNum,fromColumns.maxNum)
+        return [set([row[1:] for row in caseTable(converter)]) for converter in (fromCSV,fromColumns)]
+
+    def testAggregations(self):
+        for aggrUnit,aggrCount in [('D',1),('M',1),('Y',1),('D',7),('M',3)]:
+            csvTable,columnTable = self.readBoth(aggrUnit,aggrCount)
+            self.assertTrue(csvTable)
+            self.assertEqual(csvTable,columnTable,"readers disagree for %i%s" % (aggrCount,aggrUnit))
+
+    def testGrid(self):
+        csvTable,columnTable = self.readBoth('M',1,gridSize=0.5)
+        self.assertTrue(csvTable)
+        self.assertEqual(csvTable,columnTable)
+
+    def testGeohash(self):
+        csvTable,columnTable = self.readBoth('M',1,geohash=3)
+        self.assertTrue(csvTable)
+        self.assertEqual(csvTable,columnTable)
+
+
+if __name__ == "__main__":
+    unittest.main()
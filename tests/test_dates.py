@@ -0,0 +1,84 @@
+"""
+Checks that _DateParser's fast path for simple numeric formats accepts
+and rejects the same strings, with the same results, as strptime.
+"""
+
+import unittest
+from time import strptime
+from datetime import date
+
+from cases2kml import DateError, _DateParser, _simpleDateParser
+
+
+FORMATS = ["%Y-%m-%d","%d/%m/%Y","%m/%d/%Y","%d.%m.%Y","%Y/%d/%m","%m-%d-%Y"]
+
+# Year, month and day fields, valid or not
+YEARS = ["2001","1999","0001","0000","9999","201","20011"," 2001","2001 ","+2001","2oo1",""]
+MONTHS = ["01","1","12","00","0","13","001"," 1","1 ","-1","a",""]
+DAYS = ["01","1","9","28","29","30","31","00","0","32","001"," 1","1 ",""]
+
+
+def strptimeDate(dateString,datefmt):
+    """The date strptime makes of dateString, or None if it can't"""
+    try:
+        return date(*strptime(dateString,datefmt)[0:3])
+    except ValueError:
+        return None
+
+
+def parserDate(dateString,datefmt):
+    """The date _DateParser makes of dateString, or None if it raises
+    DateError"""
+    try:
+        return _DateParser(datefmt)(dateString)
+    except DateError:
+        return None
+
+
+def dateStrings(datefmt):
+    sep = datefmt[2]
+    fields = datefmt.split(sep)
+    for year in YEARS:
+        for month in MONTHS:
+            for day in DAYS:
+                values = {'%Y': year, '%m': month, '%d': day}
+                yield sep.join([values[field] for field in fields])
+    for extra in ["",sep,"2001" + sep,sep + "01"]:
+        yield extra
+    yield "2001" + sep + "02" + sep + "03" + sep + "04"
+
+
+class DateParserTest(unittest.TestCase):
+
+    def testFastFormats(self):
+        for datefmt in FORMATS:
+            self.assertNotEqual(_simpleDateParser(datefmt),None)
+
+    def testSameAsStrptime(self):
+        for datefmt in FORMATS:
+            accepted = 0
+            for dateString in dateStrings(datefmt):
+                expected = strptimeDate(dateString,datefmt)
+                self.assertEqual(parserDate(dateString,datefmt),expected,
+                                 "%r with %r" % (dateString,datefmt))
+                if expected != None:
+                    accepted += 1
+            self.assertTrue(accepted > 0)
+
+    def testLeapDays(self):
+        parse = _DateParser("%Y-%m-%d")
+        self.assertEqual(parse("2000-02-29"),date(2000,2,29))
+        self.assertEqual(parse("2004-2-29"),date(2004,2,29))
+        for dateString in ["2001-02-29","1900-02-29","2001-02-30","2001-04-31"]:
+            self.assertRaises(DateError,parse,dateString)
+
+    def testCached(self):
+        parse = _DateParser("%d/%m/%Y")
+        for i in xrange(3):
+            self.assertEqual(parse("04/03/2001"),date(2001,3,4))
+            self.assertRaises(DateError,parse,"30/02/2001")
+        self.assertEqual(parse.parsed,1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Checks that grid cells wrap at the antimeridian and keep their centres
+on the globe, whether or not their size divides 360 by 180 degrees.
+"""
+
+import random
+import unittest
+
+import cases2kml
+from cases2kml import _GridBinner, _GeohashBinner
+
+
+SIZES = [0.5,0.7,1.0,7.0,11.0,45.0,100.0]
+
+
+class GridTest(unittest.TestCase):
+
+    def testWrap(self):
+        for size in SIZES:
+            binner = _GridBinner(size)
+            for y in (-90.0,-45.0,0.0,33.3,90.0):
+                self.assertEqual(binner.cell(180.0,y),binner.cell(-180.0,y),"size %s" % size)
+
+    def testCentres(self):
+        for size in SIZES:
+            binner = _GridBinner(size)
+            for x,y in [(179.9,0.0),(-180.0,-90.0),(179.999,90.0),(0.0,90.0),(-0.1,-89.9)]:
+                centreX,centreY = binner.centre(binner.cell(x,y))
+                self.assertTrue(-180.0 <= centreX <= 180.0,"size %s x %s: %s" % (size,x,centreX))
+                self.assertTrue(-90.0 <= centreY <= 90.0,"size %s y %s: %s" % (size,y,centreY))
+                # The centre must be in the same cell as the point
+                self.assertEqual(binner.cell(centreX,centreY),binner.cell(x,y))
+
+    def testWholeCells(self):
+        binner = _GridBinner(0.5)
+        self.assertEqual(binner.centre(binner.cell(179.9,89.9)),(179.75,89.75))
+        self.assertEqual(binner.centre(binner.cell(0.1,0.1)),(0.25,0.25))
+
+    def testLastCells(self):
+        binner = _GridBinner(0.7)
+        centreX,centreY = binner.centre(binner.cell(179.9,89.9))
+        self.assertAlmostEqual(centreX,179.9)
+        self.assertAlmostEqual(centreY,89.95)
+
+    @unittest.skipIf(cases2kml.numpy == None,"numpy is not installed")
+    def testCells(self):
+        rand = random.Random(1)
+        x = [rand.uniform(-180.0,180.0) for i in xrange(10000)] + [-180.0,180.0,179.999999,0.0]
+        y = [rand.uniform(-90.0,90.0) for i in xrange(10000)] + [-90.0,90.0,90.0,89.999999]
+        for binner in [_GridBinner(size) for size in SIZES] + [_GridBinner(7.0,11.0),_GeohashBinner(3)]:
+            cells = binner.cells(cases2kml.numpy.array(x),cases2kml.numpy.array(y)).tolist()
+            self.assertEqual(cells,[binner.cell(*point) for point in zip(x,y)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Checks that the ways readCSV has of reading a file, serially or in
+chunks, through csv.reader or a memory map, and compressed or not, all
+tally the same cases.
+"""
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from cases2kml import Cases2kml
+from benchmarks.synthetic import writeCases
+from tests.test_backends import caseTable
+
+
+FIELDS = {'x': 0, 'y': 1, 'date': 2}
+
+
+class IngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = self.path("cases.csv")
+        writeCases(self.filename,20000,500,numDays=800)
+        csvFile = open(self.filename,"rb")
+        self.lines = csvFile.read().splitlines()
+        csvFile.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self,name):
+        return os.path.join(self.directory,name)
+
+    def writeLines(self,name,lines,newline="\n"):
+        filename = self.path(name)
+        csvFile = open(filename,"wb")
+        csvFile.write(newline.join(lines) + newline)
+        csvFile.close()
+        return filename
+
+    def wideLines(self):
+        """The lines with enough unused columns added that they are read
+        through a memory map"""
+        return [line + ",%i,unused,columns,to,split,%i" % (number,number)
+                for number,line in enumerate(self.lines)]
+
+    def read(self,filename,**options):
+        converter = Cases2kml('M',1,1.0,'FF0000FF')
+        converter.readCSV(filename,FIELDS,**options)
+        return caseTable(converter)
+
+    def assertSameCases(self,filename,**options):
+        for extra in ({},{'gridSize': 0.5}):
+            expected = self.read(self.filename,**extra)
+            self.assertTrue(expected)
+            options.update(extra)
+            self.assertEqual(self.read(filename,**options),expected)
+
+    def testWorkers(self):
+        for workers in (2,3):
+            self.assertSameCases(self.filename,workers=workers)
+
+    def testWide(self):
+        filename = self.writeLines("wide.csv",self.wideLines())
+        self.assertSameCases(filename)
+        self.assertSameCases(filename,workers=3)
+
+    def testGzip(self):
+        filename = self.path("cases.csv.gz")
+        gzipFile = gzip.open(filename,"wb")
+        gzipFile.write("\n".join(self.lines) + "\n")
+        gzipFile.close()
+        self.assertSameCases(filename)
+        # Compressed files are read serially, whatever the workers
+        self.assertSameCases(filename,workers=3)
+
+    def testCRLF(self):
+        filename = self.writeLines("crlf.csv",self.lines,"\r\n")
+        self.assertSameCases(filename)
+        self.assertSameCases(filename,workers=3)
+
+    def testWideCRLF(self):
+        filename = self.writeLines("widecrlf.csv",self.wideLines(),"\r\n")
+        self.assertSameCases(filename)
+        self.assertSameCases(filename,workers=3)
+
+    def testQuoted(self):
+        filename = self.path("quoted.csv")
+        writeCases(filename,20000,500,numDays=800,quoted=True)
+        self.assertSameCases(filename,quoteChar='"')
+        self.assertSameCases(filename,quoteChar='"',workers=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+"""
+Checks that reading a CSV file incrementally, with saved state, tallies
+the same cases as reading it in one go.
+"""
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+from cases2kml import Cases2kml, _TallyCache
+from tests.test_backends import caseTable
+
+
+FIELDS = {'x': 0, 'y': 1, 'date': 2}
+
+ROWS = ["1.5,52.5,2001-03-04,a\n",
+        "1.5,52.5,2001-03-20,a\n",
+        "-2.25,51.0,2001-04-01,b\n",
+        "0.75,53.125,2001-06-30,c\n",
+        "1.5,52.5,2001-07-02,a\n"]
+
+MORE_ROWS = ["-2.25,51.0,2001-07-15,b\n",
+             "3.0,50.0,2001-08-01,d\n",
+             "1.5,52.5,2001-08-09,a\n"]
+
+
+class StateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory,"cases.csv")
+        self.stateName = os.path.join(self.directory,"state.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeRows(self,rows,mode="wb",header=True,extra=""):
+        csvFile = open(self.filename,mode)
+        if header:
+            csvFile.write("x,y,date,id" + extra + "\n")
+        csvFile.write("".join(rows))
+        csvFile.close()
+
+    def readFull(self,**options):
+        converter = Cases2kml('M',1,1.0,'FF0000FF')
+        converter.readCSV(self.filename,FIELDS,**options)
+        return converter
+
+    def resume(self,**options):
+        """Reads the file on from the saved state, saving it again"""
+        converter = Cases2kml('M',1,1.0,'FF0000FF')
+        converter.loadState(self.stateName)
+        converter.readCSV(self.filename,FIELDS,append=True,wholeLines=True,**options)
+        converter.saveState(self.stateName)
+        return converter
+
+    def saveFirstRead(self,**options):
+        converter = Cases2kml('M',1,1.0,'FF0000FF')
+        converter.readCSV(self.filename,FIELDS,wholeLines=True,**options)
+        converter.saveState(self.stateName)
+
+    def testAppend(self):
+        for workers in (1,2):
+            self.writeRows(ROWS)
+            self.saveFirstRead(workers=workers)
+            self.writeRows(MORE_ROWS,"ab",False)
+            self.assertEqual(caseTable(self.resume(workers=workers)),caseTable(self.readFull()))
+
+    def testEarlierDate(self):
+        self.writeRows(ROWS)
+        self.saveFirstRead()
+        self.writeRows(["0.75,53.125,2000-12-25,c\n"],"ab",False)
+        converter = self.resume()
+        self.assertEqual(converter.minDate,date(2000,12,25))
+        self.assertEqual(converter.periods.starts[0],"2000-12-01")
+        self.assertEqual(caseTable(converter),caseTable(self.readFull()))
+
+    def testPartialLine(self):
+        self.writeRows(ROWS + ["-2.25,51.0,2001-0"])
+        self.saveFirstRead()
+        self.writeRows(["7-15,b\n"] + MORE_ROWS[1:],"ab",False)
+        self.assertEqual(caseTable(self.resume()),caseTable(self.readFull()))
+
+    def testPartialLineWide(self):
+        # Files with unused columns are read through an mmap
+        self.writeRows([row.replace("\n",",1,2\n") for row in ROWS] + ["-2.25,51.0,2001-0"],extra=",u,v")
+        self.saveFirstRead()
+        self.writeRows(["7-15,b,1,2\n"],"ab",False)
+        self.assertEqual(caseTable(self.resume()),caseTable(self.readFull()))
+
+    def testDifferentSettings(self):
+        self.writeRows(ROWS)
+        self.saveFirstRead()
+        self.writeRows(MORE_ROWS,"ab",False)
+        converter = Cases2kml('M',1,1.0,'FF0000FF')
+        converter.loadState(self.stateName)
+        self.assertRaises(ValueError,converter.readCSV,self.filename,FIELDS,"%Y-%d-%m",append=True)
+
+    def testRewrittenFile(self):
+        self.writeRows(ROWS)
+        self.saveFirstRead()
+        self.writeRows([row.replace("1.5,","1.6,") for row in ROWS] + MORE_ROWS)
+        self.assertRaises(ValueError,self.resume)
+
+    def testShorterFile(self):
+        self.writeRows(ROWS)
+        self.saveFirstRead()
+        self.writeRows(ROWS[:2])
+        self.assertRaises(ValueError,self.resume)
+
+
+    def testRoundTrip(self):
+        # Binned locations are keyed on ints, and ids may be any bytes
+        self.writeRows(ROWS + ["4.0,49.0,2001-02-02,caf\xe9\n"])
+        for options in ({},{'gridSize': 0.5}):
+            converter = self.readFull(**options)
+            converter.saveState(self.stateName)
+            loaded = Cases2kml('M',1,1.0,'FF0000FF')
+            loaded.loadState(self.stateName)
+            self.assertEqual(caseTable(loaded),caseTable(converter))
+            self.assertEqual(loaded.inputOptions,converter.inputOptions)
+            self.assertEqual(loaded.offset,converter.offset)
+
+
+class TallyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = _TallyCache(os.path.join(self.directory,"cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testBadEntries(self):
+        os.makedirs(self.cache.directory)
+        for key,contents in (("notgzip","not gzip"),("notstate","not a state file\n"),
+                             ("version",'{"version": 2}\n'),("truncated",'{"version": 3, "lockeys": ["a"], "ids": [null], "cells": 1}\n')):
+            path = os.path.join(self.cache.directory,key + ".gz")
+            if key == "notgzip":
+                entry = open(path,"wb")
+            else:
+                entry = gzip.open(path,"wb")
+            entry.write(contents)
+            entry.close()
+            self.assertFalse(self.cache.load(Cases2kml('M',1,1.0,'FF0000FF'),key))
+            self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()